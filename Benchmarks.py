@@ -0,0 +1,743 @@
+### Packages ###
+import os
+import sys
+import copy
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import mne
+from scipy.fft import fft, fftfreq
+from scipy.signal import welch, detrend
+import SignalDictBuilder
+import QualityMetrics
+import DictFunc
+import DatasetStore
+from DatasetStore import ChannelStore
+
+
+#### Synthetic BIDS sessions ####
+def write_brainvision(vhdr_file, data, sfreq, ch_names, resolution=0.1):
+    """
+    -----
+    Brief
+    -----
+    Writes a multiplexed IEEE_FLOAT_32 BrainVision recording (.vhdr, .vmrk and .eeg files).
+    ----------
+    Parameters
+    ----------
+    vhdr_file : string
+        Path of the header file to write. The marker and data files are written next to it.
+    data : nd-array
+        (n_channels, n_samples) array in Volts.
+    sfreq : float
+        Sampling frequency in Hz.
+    ch_names : list
+        Channel names.
+    resolution : float
+        Resolution of the stored values in uV.
+    """
+    base = os.path.splitext(vhdr_file)[0]
+    stem = os.path.basename(base)
+    with open(vhdr_file, 'w', encoding='utf-8') as f:
+        f.write('Brain Vision Data Exchange Header File Version 1.0\n\n')
+        f.write('[Common Infos]\nCodepage=UTF-8\n')
+        f.write(f'DataFile={stem}.eeg\nMarkerFile={stem}.vmrk\n')
+        f.write('DataFormat=BINARY\nDataOrientation=MULTIPLEXED\n')
+        f.write(f'NumberOfChannels={len(ch_names)}\nSamplingInterval={1e6 / sfreq}\n\n')
+        f.write('[Binary Infos]\nBinaryFormat=IEEE_FLOAT_32\n\n[Channel Infos]\n')
+        for i, name in enumerate(ch_names):
+            # Commas in channel names are escaped as \1
+            name = name.replace(',', r'\1')
+            f.write(f'Ch{i + 1}={name},,{resolution},µV\n')
+    with open(base + '.vmrk', 'w', encoding='utf-8') as f:
+        f.write('Brain Vision Data Exchange Marker File, Version 1.0\n\n')
+        f.write(f'[Common Infos]\nCodepage=UTF-8\nDataFile={stem}.eeg\n\n')
+        f.write('[Marker Infos]\nMk1=New Segment,,1,1,0\n')
+    (np.asarray(data).T * 1e6 / resolution).astype('<f4').tofile(base + '.eeg')
+
+
+def write_synthetic_session(root, subject, session, n_channels=64, n_samples=2048 * 60, sfreq=2048, n_injured=6,
+                            seed=0):
+    """
+    -----
+    Brief
+    -----
+    Writes a UMC-like BIDS session: the BrainVision recording plus its channels.tsv and electrodes.tsv sidecars.
+    The first n_injured channels are resected, the last one is an edge contact and one in ten is excluded.
+    ----------
+    Parameters
+    ----------
+    root : string
+        Root directory of the synthetic dataset.
+    subject : string
+        Subject label, without the 'sub-' prefix.
+    session : string
+        Session label, without the 'ses-' prefix.
+    n_channels : int
+        Number of recorded channels.
+    n_samples : int
+        Number of samples per channel.
+    sfreq : float
+        Sampling frequency in Hz.
+    n_injured : int
+        Number of resected channels.
+    seed : int
+        Seed of the random signals.
+
+    Returns
+    -------
+    vhdr_file : string
+        Path to the written header file.
+    """
+    folder = os.path.join(root, f'sub-{subject}', f'ses-{session}', 'ieeg')
+    os.makedirs(folder, exist_ok=True)
+    prefix = os.path.join(folder, f'sub-{subject}_ses-{session}')
+    ch_names = [f'C{i + 1:03d}' for i in range(n_channels)]
+
+    rng = np.random.default_rng(seed)
+    data = 1e-5 * rng.standard_normal((n_channels, n_samples)).cumsum(axis=1) / np.sqrt(n_samples)
+    vhdr_file = prefix + '_task-acute_ieeg.vhdr'
+    write_brainvision(vhdr_file, data, sfreq, ch_names)
+
+    status = ['excluded' if i % 10 == 9 else 'included' for i in range(n_channels)]
+    pd.DataFrame({'name': ch_names, 'type': 'ECOG', 'status_description': status}).to_csv(
+        prefix + '_task-acute_channels.tsv', sep='\t', index=False)
+    resected = ['yes' if i < n_injured else 'no' for i in range(n_channels)]
+    edge = ['yes' if i == n_channels - 1 else 'no' for i in range(n_channels)]
+    pd.DataFrame({'name': ch_names, 'x': 0.0, 'y': 0.0, 'z': 0.0, 'resected': resected, 'edge': edge}).to_csv(
+        prefix + '_electrodes.tsv', sep='\t', index=False)
+    return vhdr_file
+
+
+#### Read accounting ####
+class ReadCounter:
+    """
+    -----
+    Brief
+    -----
+    Context manager counting the files read and the bytes loaded by the sidecar (pandas.read_csv) and BrainVision
+    (mne.io.read_raw_brainvision) readers while it is active.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self._read_csv = None
+        self._read_raw = None
+
+    def __enter__(self):
+        self._read_csv = pd.read_csv
+        self._read_raw = mne.io.read_raw_brainvision
+
+        def read_csv(filepath, *args, **kwargs):
+            self.files += 1
+            self.bytes += os.path.getsize(filepath)
+            return self._read_csv(filepath, *args, **kwargs)
+
+        def read_raw_brainvision(vhdr_fname, *args, **kwargs):
+            raw = self._read_raw(vhdr_fname, *args, **kwargs)
+            base = os.path.splitext(vhdr_fname)[0]
+            # Header and markers are always parsed, the data file only when preloading
+            self.files += 2
+            self.bytes += os.path.getsize(vhdr_fname) + os.path.getsize(base + '.vmrk')
+            if kwargs.get('preload', False):
+                self.files += 1
+                self.bytes += os.path.getsize(raw.filenames[0])
+            return raw
+
+        pd.read_csv = read_csv
+        mne.io.read_raw_brainvision = read_raw_brainvision
+        return self
+
+    def __exit__(self, *exc):
+        pd.read_csv = self._read_csv
+        mne.io.read_raw_brainvision = self._read_raw
+        return False
+
+
+def _two_pass_session(vhdr_file):
+    # Reads done per session by structure_data before the single-pass loader: one channels.tsv read, two
+    # electrodes.tsv reads and two full decodes of the recording.
+    channels_info = pd.read_csv(vhdr_file.replace('acute_ieeg.vhdr', 'acute_channels.tsv'), delimiter='\t')
+    good_channels = channels_info.loc[channels_info['status_description'] == 'included', 'name'].tolist()
+    session = {'healthy': None, 'injured': None}
+    for condition, resected in (('injured', 'yes'), ('healthy', 'no')):
+        electrodes_info = pd.read_csv(vhdr_file.replace('task-acute_ieeg.vhdr', 'electrodes.tsv'), delimiter='\t')
+        channels = electrodes_info.loc[(electrodes_info['resected'] == resected) & (electrodes_info['edge'] == 'no'),
+                                       'name'].tolist()
+        common_channels = list(set(good_channels).intersection(channels))
+        if common_channels:
+            raw = mne.io.read_raw_brainvision(vhdr_file, preload=True)
+            session[condition] = raw.pick(common_channels)
+    return session
+
+
+def benchmark_session_loading(path):
+    """
+    -----
+    Brief
+    -----
+    Compares the files read, bytes loaded and time spent per session by the two-pass reads and by the single-pass
+    loader (SignalDictBuilder.load_session).
+    ----------
+    Parameters
+    ----------
+    path : string
+        Root directory of the dataset.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        One row per session and loader.
+    """
+    rows = []
+    for patient_id, situation_id, vhdr_file in SignalDictBuilder.find_sessions(path):
+        for loader_name, loader in (('two-pass', _two_pass_session), ('single-pass', SignalDictBuilder.load_session)):
+            with ReadCounter() as counter:
+                start = time.perf_counter()
+                loader(vhdr_file)
+                elapsed = time.perf_counter() - start
+            rows.append({'session': f'{patient_id}_{situation_id}', 'loader': loader_name,
+                         'files_read': counter.files, 'MB_loaded': counter.bytes / 1e6, 'time_s': elapsed})
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False))
+    return results
+
+
+def _extract_channels_per_pick(raw_object):
+    # Channel extraction before SignalDictBuilder.extract_channels: one get_data call per channel
+    return [raw_object.get_data(picks=channel_idx) for channel_idx in range(raw_object.info['nchan'])]
+
+
+def benchmark_channel_extraction(n_channels=100, n_samples=2048 * 60, sfreq=2048, repeats=5):
+    """
+    -----
+    Brief
+    -----
+    Micro-benchmark of the channel extraction on a synthetic BrainVision file: one get_data call per channel
+    against a single get_data call with row views (SignalDictBuilder.extract_channels).
+    ----------
+    Parameters
+    ----------
+    n_channels : int
+        Number of channels of the synthetic recording.
+    n_samples : int
+        Number of samples per channel.
+    sfreq : float
+        Sampling frequency in Hz.
+    repeats : int
+        Number of timed repetitions, the best one is reported.
+
+    Returns
+    -------
+    results : dict
+        Best time in seconds of each extraction path.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        vhdr_file = os.path.join(root, 'synthetic_ieeg.vhdr')
+        rng = np.random.default_rng(0)
+        write_brainvision(vhdr_file, 1e-5 * rng.standard_normal((n_channels, n_samples)), sfreq,
+                          [f'C{i + 1:03d}' for i in range(n_channels)])
+        raw = mne.io.read_raw_brainvision(vhdr_file, preload=True)
+
+    results = {}
+    for name, extract in (('per-channel get_data', _extract_channels_per_pick),
+                          ('single get_data + views', SignalDictBuilder.extract_channels)):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            channels = extract(raw)
+            times.append(time.perf_counter() - start)
+        results[name] = min(times)
+        print(f'{name}: {results[name] * 1e3:.1f} ms for {len(channels)} channels')
+    return results
+
+
+def _timed_peak(func, *args, **kwargs):
+    # Runs func once, returning its result, the elapsed time in seconds and the peak of traced memory in bytes
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def _power_line_full_fft(data, sampling_rate):
+    # power_line_noise before the targeted DFT: full complex FFT and fftfreq, then the bin nearest to 50 Hz
+    fft_values = fft(data)
+    fft_freq = fftfreq(len(data), 1 / sampling_rate)
+    return np.abs(fft_values[np.argmin(np.abs(fft_freq - 50))])
+
+
+def benchmark_power_line(n_channels=16, n_samples=2048 * 300, sampling_rate=2048):
+    """
+    -----
+    Brief
+    -----
+    Compares time and peak memory of the 50 Hz powerline amplitude computed with a full FFT per channel, with the
+    targeted DFT per channel (QualityMetrics.power_line_noise) and with the targeted DFT on the whole batch
+    (QualityMetrics.power_line_harmonics).
+    ----------
+    Parameters
+    ----------
+    n_channels : int
+        Number of synthetic channels.
+    n_samples : int
+        Number of samples per channel.
+    sampling_rate : int
+        Sampling rate in Hz.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        Time, peak memory and largest deviation from the full FFT values, per implementation.
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(n_samples) / sampling_rate
+    data = rng.standard_normal((n_channels, n_samples)) + 0.5 * np.sin(2 * np.pi * 50 * t)
+
+    reference, fft_time, fft_peak = _timed_peak(lambda: np.array([_power_line_full_fft(x, sampling_rate)
+                                                                   for x in data]))
+    single, single_time, single_peak = _timed_peak(lambda: np.array([QualityMetrics.power_line_noise(x, sampling_rate)
+                                                                      for x in data]))
+    (batch, _), batch_time, batch_peak = _timed_peak(QualityMetrics.power_line_harmonics, data, sampling_rate)
+
+    results = pd.DataFrame({'implementation': ['full FFT per channel', 'targeted DFT per channel',
+                                               'targeted DFT batch'],
+                            'time_s': [fft_time, single_time, batch_time],
+                            'peak_MB': [fft_peak / 1e6, single_peak / 1e6, batch_peak / 1e6],
+                            'max_rel_error': [0.0, np.max(np.abs(single - reference) / reference),
+                                              np.max(np.abs(batch[:, 0] - reference) / reference)]})
+    print(results.to_string(index=False))
+    return results
+
+
+def _hurst_fathon(signal):
+    """The per-signal fathon.DFA implementation hurst_exponent used before the batched DFA engine."""
+    import fathon
+    from fathon import fathonUtils as fu
+    pydcca = fathon.DFA(fu.toAggregated(signal))
+    pydcca.computeFlucVec(fu.linRangeByStep(16, len(signal) / 8, step=50), polOrd=1)
+    H, _ = pydcca.fitFlucVec()
+    return H
+
+
+def benchmark_hurst(n_channels=64, n_samples=2048 * 30, n_jobs=-1):
+    """
+    -----
+    Brief
+    -----
+    Compares the time of the Hurst exponent computed with one fathon.DFA object per channel and with the batched
+    DFA engine (QualityMetrics.hurst_batch), in one process and across n_jobs processes.
+    ----------
+    Parameters
+    ----------
+    n_channels : int
+        Number of synthetic channels.
+    n_samples : int
+        Number of samples per channel.
+    n_jobs : int
+        Number of processes of the parallel run. -1 uses every core.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        Time and largest deviation from the fathon H values, per implementation.
+    """
+    rng = np.random.default_rng(0)
+    data = np.cumsum(rng.standard_normal((n_channels, n_samples)), axis=-1)
+
+    reference, fathon_time, _ = _timed_peak(lambda: np.array([_hurst_fathon(x) for x in data]))
+    batch, batch_time, _ = _timed_peak(QualityMetrics.hurst_batch, data)
+    parallel, parallel_time, _ = _timed_peak(QualityMetrics.hurst_batch, data, n_jobs=n_jobs)
+
+    results = pd.DataFrame({'implementation': ['fathon.DFA per channel', 'batched DFA',
+                                               f'batched DFA, n_jobs={n_jobs}'],
+                            'time_s': [fathon_time, batch_time, parallel_time],
+                            'max_abs_error': [0.0, np.max(np.abs(batch - reference)),
+                                              np.max(np.abs(parallel - reference))]})
+    print(results.to_string(index=False))
+    return results
+
+
+def _pca_and_auc_sklearn(data, sampling_rate):
+    """The per-signal sklearn PCA implementation pca_and_auc used before the batched eigendecomposition."""
+    from sklearn.decomposition import PCA
+    from sklearn.metrics import auc
+    len_data_seconds = len(data) / sampling_rate
+    pca = PCA().fit(data.reshape(int(-len_data_seconds), int(len_data_seconds)))
+    cumulative_variance = np.cumsum(pca.explained_variance_ratio_)
+    return auc(np.arange(len(cumulative_variance)), cumulative_variance) / len(cumulative_variance)
+
+
+def benchmark_pca_auc(n_channels=16, n_samples=2048 * 600, sampling_rate=2048):
+    """
+    -----
+    Brief
+    -----
+    Compares the time of the PCA-AUC computed with one sklearn PCA per channel and with the batched covariance
+    eigendecomposition (QualityMetrics.pca_auc_batch), in memory and incrementally.
+    ----------
+    Parameters
+    ----------
+    n_channels : int
+        Number of synthetic channels.
+    n_samples : int
+        Number of samples per channel, a whole number of seconds so that the sklearn reshape works.
+    sampling_rate : int
+        Sampling rate in Hz.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        Time, peak memory and largest deviation from the sklearn values, per implementation.
+    """
+    rng = np.random.default_rng(0)
+    data = np.cumsum(rng.standard_normal((n_channels, n_samples)), axis=-1)
+
+    reference, sklearn_time, sklearn_peak = _timed_peak(lambda: np.array([_pca_and_auc_sklearn(x, sampling_rate)
+                                                                          for x in data]))
+    batch, batch_time, batch_peak = _timed_peak(QualityMetrics.pca_auc_batch, data, sampling_rate)
+    incremental, incremental_time, incremental_peak = _timed_peak(QualityMetrics.pca_auc_batch, data, sampling_rate,
+                                                                  method='incremental')
+
+    results = pd.DataFrame({'implementation': ['sklearn PCA per channel', 'batched covariance',
+                                               'batched incremental covariance'],
+                            'time_s': [sklearn_time, batch_time, incremental_time],
+                            'peak_MB': [sklearn_peak / 1e6, batch_peak / 1e6, incremental_peak / 1e6],
+                            'max_abs_error': [0.0, np.max(np.abs(batch - reference)),
+                                              np.max(np.abs(incremental - reference))]})
+    print(results.to_string(index=False))
+    return results
+
+
+class TraversalCounter:
+    """
+    -----
+    Brief
+    -----
+    Context manager counting the walks over nested datasets (or over nested results) while it is active: every
+    call of DictFunc.apply_function_to_timeseries, ChannelStore.from_nested, DatasetStore._map_skeleton (used by
+    ChannelStore.from_channels and ChannelStore.to_nested) or of the per-metric path's _apply_per_metric and
+    _combine_pair is one traversal, its recursive calls are not counted. Walks nested in another walk (e.g. the
+    skeleton mapped by from_nested) are counted on their own.
+    """
+
+    def __init__(self):
+        self.traversals = 0
+        self._depth = {}
+        self._functions = {}
+
+    def __enter__(self):
+        targets = ((DictFunc, 'apply_function_to_timeseries'), (ChannelStore, 'from_nested'),
+                   (DatasetStore, '_map_skeleton'), (sys.modules[__name__], '_apply_per_metric'),
+                   (sys.modules[__name__], '_combine_pair'))
+        for owner, name in targets:
+            # vars() rather than getattr() so that classmethods are restored as such
+            func = vars(owner)[name]
+            self._functions[owner, name] = func
+            if isinstance(func, classmethod):
+                setattr(owner, name, classmethod(self._counted(name, func.__func__)))
+            else:
+                setattr(owner, name, self._counted(name, func))
+        return self
+
+    def _counted(self, name, func):
+        self._depth[name] = 0
+
+        def counted(*args, **kwargs):
+            if self._depth[name] == 0:
+                self.traversals += 1
+            self._depth[name] += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._depth[name] -= 1
+        return counted
+
+    def __exit__(self, *exc):
+        for (owner, name), func in self._functions.items():
+            setattr(owner, name, func)
+        return False
+
+
+#### Per-metric quality path before the one-pass engine ####
+# The dummy_quality path of the original code: every metric is a scalar function of one channel, the dataset is
+# traversed once per metric and once per binarize (with leaves found by scanning their samples), and the masks
+# are combined with deep copies. The original functions are reproduced here, with the broken calls of the old
+# dummy_quality (undefined variable in noise_classify, type= keyword arguments) fixed.
+def _apply_per_metric(signal, func, *args, **kwargs):
+    # apply_function_to_timeseries, which checked every sample to tell time series from containers
+    if isinstance(signal, dict):
+        return {key: _apply_per_metric(value, func, *args, **kwargs) for key, value in signal.items()}
+    elif isinstance(signal, (list, np.ndarray)):
+        if all(isinstance(x, (int, float, np.number)) for x in signal):
+            return func(signal, *args, **kwargs)
+        return [_apply_per_metric(item, func, *args, **kwargs) for item in signal]
+    return signal
+
+
+def _ladder(value, thresholds, passed):
+    # Threshold loops of the *_classify functions: the level is len(thresholds) - i at the first threshold
+    # passed, 1 if none is
+    for i, threshold in enumerate(thresholds):
+        if passed(value, threshold):
+            return len(thresholds) - i
+    return 1
+
+
+def _qcod_per_metric(signal, fs, signal_type):
+    # noise_classify: one Welch PSD per threshold of the ladder
+    thresholds = {'eeg': [0.3, 0.1, 0.06, 0.04, 0.03], 'ecg': [0.98, 0.9, 0.57, 0.37]}[signal_type.lower()]
+    masks = []
+    for threshold in thresholds:
+        _, psd = welch(signal, fs, nperseg=(len(signal) // 2))
+        psdquarters = int(round(len(psd)) / 4)
+        q1 = np.sum(psd[:psdquarters])
+        q3 = sum(psd[2 * psdquarters + 1:3 * psdquarters])
+        masks.append(1 if (q1 - q3) / (q1 + q3) >= threshold else 0)
+    if all(mask == 0 for mask in masks):
+        return 0
+    return len(thresholds) - masks.index(1)
+
+
+def _completeness_per_metric(signal):
+    return np.isnan(signal).sum() / len(signal) * 100
+
+
+def _uniqueness_per_metric(signal):
+    signal = np.asarray(signal)
+    return np.sum(signal[:-1] != signal[1:]) / max(len(signal) - 1, 1) * 100
+
+
+def _amplitude_per_metric(signal, signal_type):
+    thresholds = {'eeg': [100, 200, 300], 'ecg': [5, 10, 15]}[signal_type.lower()]
+    return _ladder(np.max(np.abs(detrend(signal))), thresholds, lambda value, threshold: value <= threshold)
+
+
+def _pca_per_metric(signal, fs, signal_type):
+    thresholds = {'eeg': [0.90, 0.7519, 0.6211], 'ecg': [0.8679, 0.7698, 0.60]}[signal_type.lower()]
+    return _ladder(_pca_and_auc_sklearn(signal, fs), thresholds, lambda value, threshold: value > threshold)
+
+
+def _snr_per_metric(signal):
+    # calculate_snr: the reference sine wave was rebuilt for every channel
+    t = np.arange(0, 15, 1 / 1000)
+    rms_base_signal = np.sqrt(np.mean((1.5 * np.sin(2 * np.pi * 5 * t)) ** 2))
+    rms_noise = np.sqrt(np.mean(np.array(signal) ** 2))
+    snr = 20 * np.log10(rms_base_signal / rms_noise) if rms_noise > 0 else np.inf
+    if snr > 5:
+        return 4
+    elif 5 > snr > 1:
+        return 3
+    elif 1 > snr > -5:
+        return 2
+    return 1
+
+
+def _saturation_per_metric(signal, fs, signal_type):
+    # saturation: the signal was detrended a second time, after the amplitude metric
+    th = {'eeg': 1e-6, 'ecg': 15}[signal_type.lower()]
+    detrended_signal = detrend(signal)
+    is_max_amplitude = np.isclose(detrended_signal, np.max(detrended_signal), atol=th)
+    changes = np.diff(is_max_amplitude.astype(int))
+    segment_starts = np.where(changes == 1)[0] + 1
+    segment_ends = np.where(changes == -1)[0] + 1
+    if is_max_amplitude[0]:
+        segment_starts = np.r_[0, segment_starts]
+    if is_max_amplitude[-1]:
+        segment_ends = np.r_[segment_ends, len(is_max_amplitude)]
+    segment_lengths = segment_ends - segment_starts
+    total_saturation_duration = np.sum(segment_lengths[segment_lengths >= int(200 * fs / 1000)]) / fs
+
+    signal_duration = len(signal) / fs
+    if total_saturation_duration < signal_duration / 4:
+        return 4
+    elif signal_duration / 4 <= total_saturation_duration < signal_duration / 2:
+        return 3
+    elif signal_duration / 2 <= total_saturation_duration < (signal_duration * 3) / 4:
+        return 2
+    return 1
+
+
+def _power_line_per_metric(signal, fs, signal_type):
+    thresholds = {'eeg': [0.843, 1.325, 2.660], 'ecg': [0.189, 0.469, 1.055]}[signal_type.lower()]
+    return _ladder(_power_line_full_fft(signal, fs), thresholds, lambda value, threshold: value <= threshold)
+
+
+def _binarize_per_metric(values, lower_bound):
+    if isinstance(values, (np.ndarray, list)):
+        return (np.array(values) >= lower_bound).astype(int).tolist()
+    return [1] if values >= lower_bound else [0]
+
+
+def _combine_pair(value1, value2):
+    # combine_nested_masks: bitwise AND of two nested masks, on deep copies
+    if isinstance(value1, dict) and isinstance(value2, dict):
+        result = copy.deepcopy(value1)
+        for key, value in value2.items():
+            result[key] = _combine_pair(result[key], value) if key in result else copy.deepcopy(value)
+        return result
+    elif isinstance(value1, list) and isinstance(value2, list):
+        result = copy.deepcopy(value1)
+        for i, value in enumerate(value2):
+            result[i] = _combine_pair(result[i], value)
+        return result
+    return value1 & value2
+
+
+def _combine_per_metric(masks):
+    # The masks were combined two at a time
+    combined = masks[0]
+    for mask in masks[1:]:
+        combined = _combine_pair(combined, mask)
+    return combined
+
+
+def _dummy_quality_per_metric(dataset, metrics, signal_type='EEG', fs=2048):
+    """The masks of dummy_quality with the original per-metric path: two traversals per metric, then one per AND."""
+    functions = {'QCOD': lambda signal: _qcod_per_metric(signal, fs, signal_type),
+                 'Completeness': _completeness_per_metric,
+                 'Uniqueness': _uniqueness_per_metric,
+                 'Hurst': _hurst_fathon,
+                 'Amplitude': lambda signal: _amplitude_per_metric(signal, signal_type),
+                 'PCA': lambda signal: _pca_per_metric(signal, fs, signal_type),
+                 'SNR': _snr_per_metric,
+                 'Saturation': lambda signal: _saturation_per_metric(signal, fs, signal_type),
+                 'Powerline': lambda signal: _power_line_per_metric(signal, fs, signal_type)}
+    masks = []
+    for name, func in functions.items():
+        if name in metrics:
+            values = _apply_per_metric(dataset, func)
+            masks.append(_apply_per_metric(values, _binarize_per_metric, lower_bound=metrics[name]))
+    return _combine_per_metric(masks)
+
+
+def benchmark_quality_traversals(n_subjects=3, n_channels=8, n_samples=2048 * 10, fs=2048):
+    """
+    -----
+    Brief
+    -----
+    Compares the number of dataset traversals and the time of the dummy_quality masks computed with the original
+    per-metric path (one traversal per metric, per binarize and per mask combination, scalar metrics per channel)
+    and with the one-pass engine on batched kernels (DictFunc.evaluate_quality: one walk to build the store, one to
+    map its skeleton and one to_nested per metric and for the mask), for all the metrics.
+    ----------
+    Parameters
+    ----------
+    n_subjects : int
+        Number of synthetic subjects per condition.
+    n_channels : int
+        Number of channels per subject.
+    n_samples : int
+        Number of samples per channel.
+    fs : int
+        Sampling rate in Hz.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        Traversals, time and whether the masks are equal, per implementation.
+    """
+    rng = np.random.default_rng(0)
+    # Same layout as the structure_data dictionary: lists of (1, n_samples) channels per subject
+    dataset = {condition: [[rng.standard_normal((1, n_samples)) * 1e-5 for _ in range(n_channels)]
+                           for _ in range(n_subjects)] for condition in ('healthy', 'injured')}
+    metrics = {'QCOD': 4, 'Completeness': 95, 'Uniqueness': 95, 'Hurst': 0.9, 'Amplitude': 3, 'PCA': 2, 'SNR': 2,
+               'Saturation': 3, 'Powerline': 3}
+
+    with TraversalCounter() as per_metric_counter:
+        start = time.perf_counter()
+        reference = _dummy_quality_per_metric(dataset, metrics, fs=fs)
+        per_metric_time = time.perf_counter() - start
+    with TraversalCounter() as one_pass_counter:
+        start = time.perf_counter()
+        _, mask = DictFunc.evaluate_quality(dataset, metrics, fs=fs)
+        one_pass_time = time.perf_counter() - start
+
+    results = pd.DataFrame({'implementation': ['one traversal per metric, binarize and AND', 'one-pass engine'],
+                            'traversals': [per_metric_counter.traversals, one_pass_counter.traversals],
+                            'time_s': [per_metric_time, one_pass_time],
+                            'same_mask': [True, mask == reference]})
+    print(results.to_string(index=False))
+    return results
+
+
+def benchmark_parallel_quality(n_subjects=4, n_channels=16, n_samples=2048 * 30, fs=2048, n_jobs=(2, 4, -1)):
+    """
+    -----
+    Brief
+    -----
+    Times the one-pass quality engine (DictFunc.evaluate_quality) on one core and on process pools of several
+    sizes reading the channels from shared memory.
+    ----------
+    Parameters
+    ----------
+    n_subjects : int
+        Number of synthetic subjects per condition.
+    n_channels : int
+        Number of channels per subject.
+    n_samples : int
+        Number of samples per channel.
+    fs : int
+        Sampling rate in Hz.
+    n_jobs : tuple
+        Pool sizes to time. -1 uses every core.
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        Time, speed-up over one core and whether the masks are equal, per pool size.
+    """
+    rng = np.random.default_rng(0)
+    dataset = {condition: [[rng.standard_normal((1, n_samples)) * 1e-5 for _ in range(n_channels)]
+                           for _ in range(n_subjects)] for condition in ('healthy', 'injured')}
+    metrics = {'QCOD': 4, 'Completeness': 95, 'Uniqueness': 95, 'Hurst': 0.9, 'Amplitude': 3, 'SNR': 2,
+               'Saturation': 3, 'Powerline': 3}
+
+    start = time.perf_counter()
+    _, reference = DictFunc.evaluate_quality(dataset, metrics, fs=fs)
+    times = [time.perf_counter() - start]
+    same = [True]
+    for jobs in n_jobs:
+        start = time.perf_counter()
+        _, mask = DictFunc.evaluate_quality(dataset, metrics, fs=fs, n_jobs=jobs)
+        times.append(time.perf_counter() - start)
+        same.append(mask == reference)
+
+    results = pd.DataFrame({'n_jobs': [1] + [os.cpu_count() if jobs == -1 else jobs for jobs in n_jobs],
+                            'time_s': times, 'speed_up': times[0] / np.array(times), 'same_mask': same})
+    print(results.to_string(index=False))
+    return results
+
+
+if __name__ == '__main__':
+    mne.set_log_level('error')
+    with tempfile.TemporaryDirectory() as root:
+        for s in range(3):
+            write_synthetic_session(root, f'{s + 1:02d}', 'SITUATION1A', seed=s)
+
+        ## Single-pass BIDS session loader ##
+        benchmark_session_loading(root)
+
+    ## Vectorized channel extraction ##
+    benchmark_channel_extraction()
+
+    ## Powerline estimator ##
+    benchmark_power_line()
+
+    ## Batched DFA / Hurst exponent ##
+    benchmark_hurst()
+
+    ## Batched PCA-AUC ##
+    benchmark_pca_auc()
+
+    ## One-pass dummy_quality engine ##
+    benchmark_quality_traversals()
+
+    ## Parallel quality evaluation ##
+    benchmark_parallel_quality()
@@ -0,0 +1,299 @@
+### Packages ###
+from numbers import Number
+import numpy as np
+from SignalDictBuilder import ChannelHandle
+
+
+def is_leaf(signal):
+    """
+    -----
+    Brief
+    -----
+    Decides whether a list or array is a single time series (leaf) or a container of time series, looking at
+    its dimensions or at its first element only, instead of scanning every sample.
+    ----------
+    Parameters
+    ----------
+    signal : list or nd-array
+        Node of the dataset.
+
+    Returns
+    -------
+    leaf : bool
+        True for numeric 1D arrays, empty lists and lists of numbers. 1D object arrays (e.g. ragged channels) are
+        containers.
+    """
+    if isinstance(signal, np.ndarray):
+        return signal.ndim <= 1 and signal.dtype != object
+    return len(signal) == 0 or isinstance(signal[0], (Number, np.number))
+
+
+class ChannelStore:
+    def __init__(self, values, offsets, paths, skeleton=None):
+        """
+        -----
+        Brief
+        -----
+        Flat, array-backed dataset: every channel's samples are concatenated in a single 1D array (ragged store)
+        and channel i spans values[offsets[i]:offsets[i + 1]]. Channels are stored sorted by length, so the
+        channels of equal length are contiguous and can be mapped as (n_channels, n_samples) views without
+        copying. A path index maps every path prefix (e.g. condition, subject) to its channels.
+        ----------
+        Parameters
+        ----------
+        values : 1D-array
+            Concatenated samples of all the channels.
+        offsets : 1D-array
+            n_channels + 1 start offsets of the channels in values.
+        paths : list
+            Path (tuple of keys) of each channel, e.g. ('healthy', 0, 3, 0) in a structure_data dictionary.
+        skeleton : dict or list
+            Nested structure of the original dataset, with placeholders of the channel positions in place of the
+            time series. Used by to_nested. Default: None.
+        """
+        self.values = values
+        self.offsets = offsets
+        self.paths = paths
+        self.skeleton = skeleton
+        self.index = {}
+        for position, path in enumerate(paths):
+            for depth in range(len(path) + 1):
+                self.index.setdefault(path[:depth], []).append(position)
+        self.index = {prefix: np.array(positions) for prefix, positions in self.index.items()}
+
+    @classmethod
+    def from_channels(cls, paths, channels, skeleton=None, allocate=None):
+        """
+        -----
+        Brief
+        -----
+        Builds the store from (path, 1D channel) pairs, copying every channel once into the flat array. The
+        lengths are read from the shapes, so ChannelHandles are only read one at a time, when they are copied.
+        ----------
+        Parameters
+        ----------
+        paths : list
+            Path of each channel.
+        channels : list
+            1D arrays (or ChannelHandles, read here) of each channel.
+        skeleton : dict or list
+            Nested structure holding a placeholder with the position in paths of each channel. Default: None.
+        allocate : function
+            Called with the total number of samples, returns the 1D float64 array the channels are copied to,
+            e.g. backed by shared memory. Default: None (np.empty).
+
+        Returns
+        -------
+        store : ChannelStore
+        """
+        channels = list(channels)
+        lengths = np.array([channel.shape[-1] if isinstance(channel, ChannelHandle) else np.size(channel)
+                            for channel in channels], dtype=np.int64)
+        # Stable sort by length: channels of equal length end up contiguous, in their original order
+        order = np.argsort(lengths, kind='stable')
+        offsets = np.zeros(len(channels) + 1, dtype=np.int64)
+        np.cumsum(lengths[order], out=offsets[1:])
+
+        values = np.empty(offsets[-1], dtype=np.float64) if allocate is None else allocate(int(offsets[-1]))
+        try:
+            for i, position in enumerate(order):
+                values[offsets[i]:offsets[i + 1]] = np.asarray(channels[position]).reshape(-1)
+        except BaseException:
+            # The traceback keeps this frame alive: dropping the view lets the caller free an allocated buffer
+            del values
+            raise
+
+        # Position of each original channel in the sorted store
+        stored = np.empty(len(channels), dtype=np.int64)
+        stored[order] = np.arange(len(channels))
+        if skeleton is not None:
+            skeleton = _map_skeleton(skeleton, lambda i: _Channel(int(stored[i])))
+        return cls(values, offsets, [paths[position] for position in order], skeleton)
+
+    @classmethod
+    def from_nested(cls, dataset, allocate=None):
+        """
+        -----
+        Brief
+        -----
+        Builds the store from a nested dataset (dicts and lists of time series, e.g. the structure_data
+        dictionary), with the same leaf rules as apply_function_to_timeseries: 1D arrays and lists of numbers are
+        channels, and 2D arrays (or ChannelHandles) are lists of channels.
+        ----------
+        Parameters
+        ----------
+        dataset : dict or list
+            Nested dataset.
+        allocate : function
+            Allocator of the flat array of samples (see from_channels). Default: None (np.empty).
+
+        Returns
+        -------
+        store : ChannelStore
+        """
+        paths = []
+        channels = []
+
+        def walk(node, path):
+            if isinstance(node, dict):
+                return {key: walk(value, path + (key,)) for key, value in node.items()}
+            if isinstance(node, ChannelHandle):
+                # A (1, n_samples) channel, left unread until from_channels copies it
+                paths.append(path + (0,))
+                channels.append(node)
+                return [_Channel(len(channels) - 1)]
+            if isinstance(node, (list, np.ndarray)):
+                if is_leaf(node):
+                    paths.append(path)
+                    channels.append(node)
+                    return _Channel(len(channels) - 1)
+                return [walk(item, path + (i,)) for i, item in enumerate(node)]
+            return node
+
+        skeleton = walk(dataset, ())
+        return cls.from_channels(paths, channels, skeleton, allocate=allocate)
+
+    @classmethod
+    def from_records(cls, records, fields=('condition', 'subject', 'session', 'channel')):
+        """
+        -----
+        Brief
+        -----
+        Builds the store from ChannelRecords (SignalDictBuilder.iter_channels), each channel's path being the
+        values of the given record fields.
+        ----------
+        Parameters
+        ----------
+        records : iterable
+            ChannelRecords.
+        fields : tuple
+            Record fields making the path. Default: ('condition', 'subject', 'session', 'channel').
+
+        Returns
+        -------
+        store : ChannelStore
+        """
+        records = list(records)
+        return cls.from_channels([tuple(getattr(record, field) for field in fields) for record in records],
+                                 [record.data for record in records])
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def lengths(self):
+        """Number of samples of each channel."""
+        return np.diff(self.offsets)
+
+    def channel(self, position):
+        """1D view of the samples of the channel at position."""
+        return self.values[self.offsets[position]:self.offsets[position + 1]]
+
+    def select(self, *prefix):
+        """Positions of the channels whose path starts with prefix, e.g. select('healthy', 0)."""
+        return self.index.get(tuple(prefix), np.array([], dtype=np.int64))
+
+    def blocks(self):
+        """
+        -----
+        Brief
+        -----
+        Yields the runs of contiguous channels of equal length as (n_channels, n_samples) views of the store.
+        ----------
+        Returns
+        -------
+        blocks : generator
+            (start position, stop position, block) tuples.
+        """
+        lengths = self.lengths
+        start = 0
+        while start < len(lengths):
+            stop = start + np.searchsorted(lengths[start:], lengths[start], side='right')
+            block = self.values[self.offsets[start]:self.offsets[stop]].reshape(stop - start, lengths[start])
+            yield start, stop, block
+            start = stop
+
+    def map(self, func, *args, batched=False, **kwargs):
+        """
+        -----
+        Brief
+        -----
+        Applies a metric to every channel of the store.
+        ----------
+        Parameters
+        ----------
+        func : function
+            Metric taking a 1D channel or, if batched, a (n_channels, n_samples) block and returning one value per
+            channel. Arrays returned for the blocks (e.g. structured arrays of several metrics) are concatenated.
+        *args : positional arguments, optional
+            Additional positional arguments to be passed to the function.
+        batched : bool
+            Call func once per block of equal-length channels instead of once per channel. Default: False.
+        **kwargs : keyword arguments, optional
+            Additional keyword arguments to be passed to the function.
+
+        Returns
+        -------
+        results : nd-array
+            Result of each channel, in store order.
+        """
+        results = []
+        if batched:
+            for start, stop, block in self.blocks():
+                block_results = func(block, *args, **kwargs)
+                if len(block_results) != stop - start:
+                    raise ValueError(f"{getattr(func, '__name__', func)} returned {len(block_results)} values "
+                                     f"for a block of {stop - start} channels.")
+                results.append(block_results)
+            if results and all(isinstance(block_results, np.ndarray) for block_results in results):
+                return np.concatenate(results)
+            results = [value for block_results in results for value in block_results]
+        else:
+            results = [func(self.channel(position), *args, **kwargs) for position in range(len(self))]
+        try:
+            return np.array(results)
+        except ValueError:
+            # Results of different shapes are kept as objects
+            array = np.empty(len(results), dtype=object)
+            array[:] = results
+            return array
+
+    def to_nested(self, results):
+        """
+        -----
+        Brief
+        -----
+        Puts per-channel results back into the nested shape of the dataset the store was built from, i.e. the
+        shape apply_function_to_timeseries returns.
+        ----------
+        Parameters
+        ----------
+        results : nd-array or list
+            Result of each channel, in store order (ChannelStore.map).
+
+        Returns
+        -------
+        nested : dict or list
+            Nested results.
+        """
+        if self.skeleton is None:
+            raise ValueError("The store was not built from a nested dataset (use ChannelStore.from_nested).")
+        results = results.tolist() if isinstance(results, np.ndarray) else list(results)
+        return _map_skeleton(self.skeleton, lambda position: results[position])
+
+
+class _Channel:
+    """Placeholder of a channel in a nested skeleton."""
+    __slots__ = ('position',)
+
+    def __init__(self, position):
+        self.position = position
+
+
+def _map_skeleton(skeleton, func):
+    """Copy of a nested skeleton with func applied to the position of each of its channels."""
+    if isinstance(skeleton, dict):
+        return {key: _map_skeleton(value, func) for key, value in skeleton.items()}
+    if isinstance(skeleton, list):
+        return [_map_skeleton(item, func) for item in skeleton]
+    return func(skeleton.position) if isinstance(skeleton, _Channel) else skeleton
@@ -2,13 +2,12 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from matplotlib.colors import LinearSegmentedColormap, BoundaryNorm
 from QualityMetrics import *
-import copy
-from SignalDictBuilder import structure_data
-
-# Importing data #
-path = '/Users/Asus/AISYM4MED_1/UMC_data/UMC_data'
-data = structure_data(path, 'classifier')
-
+import os
+from numbers import Number
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from SignalDictBuilder import structure_data, ChannelHandle
+from DatasetStore import ChannelStore, is_leaf
 
 #### Colormap functions ####
 # Colormap with predefined levels of quality for both ECG and EEG data #
@@ -123,6 +122,37 @@ def binary_colormap(mask, title):
 
 
 ######## QCoD map ########
+# QCoD thresholds of each quality level, from the highest level down
+QCOD_THRESHOLDS = {'eeg': [0.3, 0.1, 0.06, 0.04, 0.03],
+                   'ecg': [0.98, 0.9, 0.57, 0.37]}
+
+
+def qcod_levels(qcod, signal_type='EEG'):
+    """
+    -----
+    Brief
+    -----
+    Grades QCoD scores against the whole threshold ladder of the signal type at once.
+    ----------
+    Parameters
+    ----------
+    qcod : float or nd-array
+        QCoD score(s), from qcod_score in QualityMetrics.
+    signal_type : str, optional
+        Type of signal being analyzed. Default is 'EEG'.
+
+    Returns
+    -------
+    levels : int or nd-array
+        Number of thresholds reached by each score, from 0 (no quality) to the number of thresholds (high quality).
+    """
+    # Checking which signal is being analysed to retrieve its quality thresholds.
+    thresholds = np.sort(QCOD_THRESHOLDS.get(signal_type.lower(), []))
+    # A score reaches every threshold lower than or equal to it
+    levels = np.searchsorted(thresholds, qcod, side='right')
+    return np.where(np.isnan(qcod), 0, levels)
+
+
 def noise_classify(signal, fs, signal_type='EEG'):
     """
     -----
@@ -150,28 +180,34 @@ def noise_classify(signal, fs, signal_type='EEG'):
         Level 1: Bad quality signal
         Level 0: No quality signal
     """
-    # Define thresholds for different signal types
-    thresholds_dict = {'eeg': [0.3, 0.1, 0.06, 0.04, 0.03],
-                       'ecg': [0.98, 0.9, 0.57, 0.37]}
-    # Checking which signal is being analysed to retrieve its quality thresholds.
-    thresholds = thresholds_dict.get(signal_type.lower(), [])
-    num_levels = len(thresholds)
-
-    masks = []
-    # Determination of the signal quality from the multiple threshold levels.
-    for threshold in thresholds:
-        mask, _, _ = QCod(fs, threshold, data)
-        masks.append(mask)
-
-    # Determine result
-    if all(mask == 0 for mask in masks):
-        results = 0  # No quality signal
-    elif masks[0] == 1:
-        results = num_levels  # High quality signal
-    else:
-        results = num_levels - masks.index(1)
+    # The PSD and QCoD score are computed once, then graded against all the thresholds
+    qcod, _, _ = qcod_score(fs, signal)
+    return int(qcod_levels(qcod, signal_type))
+
+
+def noise_classify_batch(signals, fs, signal_type='EEG'):
+    """
+    -----
+    Brief
+    -----
+    Batched noise_classify: classifies many signals of the same length with a single Welch call.
+    ----------
+    Parameters
+    ----------
+    signals : nd-array
+        (n_channels, n_samples) array with the signals to be analyzed.
+    fs : int
+        Sampling frequency.
+    signal_type : str, optional
+        Type of signal being analyzed. Default is 'EEG'.
 
-    return results
+    Returns:
+    -------
+    results : nd-array
+        Classification level of each signal, as in noise_classify.
+    """
+    qcod, _, _ = qcod_score(fs, signals)
+    return qcod_levels(qcod, signal_type)
 
 
 ### Completness ###
@@ -258,6 +294,37 @@ def hurst_classify(signal):
 
 
 ##### amplitude ######
+# Maximum amplitude of each quality level, in uV for EEG and mV for ECG
+AMPLITUDE_THRESHOLDS = {'eeg': [100, 200, 300],
+                        'ecg': [5, 10, 15]}
+
+
+def amplitude_levels(max_amplitude, signal_type='EEG'):
+    """
+    -----
+    Brief
+    -----
+    Grades maximum amplitudes against the amplitude threshold ladder, for a single value or a whole array.
+    ----------
+    Parameters
+    ----------
+    max_amplitude : float or nd-array
+        Maximum amplitude(s) of the signals.
+    signal_type : string
+        If the signal is an 'EEG' or 'ECG'.
+
+    Returns:
+    -------
+    levels : int or nd-array
+        len(thresholds) up to the first threshold (included), one level less past each following threshold,
+        and at least 1, as in classify_amplitude.
+    """
+    thresholds = np.sort(AMPLITUDE_THRESHOLDS.get(signal_type.lower(), []))
+    # Number of thresholds strictly below each amplitude (NaN is sorted past all of them)
+    levels = len(thresholds) - np.searchsorted(thresholds, max_amplitude, side='left')
+    return np.maximum(levels, 1)
+
+
 def classify_amplitude(signal, signal_type='EEG'):
     """
     -----
@@ -290,34 +357,43 @@ def classify_amplitude(signal, signal_type='EEG'):
         Level 1 - Poor Quality if amplitude > 15 mV.
     """
 
-    # Type of signal has different treshold
-    if signal_type.lower() == 'eeg':
-        thresholds = [100, 200, 300]
-    if signal_type == 'ecg':
-        thresholds = [5, 10, 15]
-
-    # List to save classification results
     max_amplitude = amplitude(signal)
+    # Type of signal has different thresholds
+    c = int(amplitude_levels(max_amplitude, signal_type))
+    return c
 
-    # Sort the thresholds to ensure they are in ascending order
-    thresholds.sort()
 
-    # Initialize classification value and description
-    c = 0
+##### PCA noise analysis #####
+# Relative PCA AUC above which each quality level is reached
+PCA_THRESHOLDS = {'eeg': [0.90, 0.7519, 0.6211],
+                  'ecg': [0.8679, 0.7698, 0.60]}
 
-    # Determine classification based on thresholds
-    for i, threshold in enumerate(thresholds):
-        if max_amplitude <= threshold:
-            c = len(thresholds) - i
-            break
-    else:
-        # If max_amplitude is greater than all thresholds
-        c = 1
 
-    return c
+def pca_levels(rel_PCA_AUC, signal_type='EEG'):
+    """
+    -----
+    Brief
+    -----
+    Grades relative PCA AUC values against the PCA threshold ladder, for a single value or a whole array.
+    ----------
+    Parameters
+    ----------
+    rel_PCA_AUC : float or nd-array
+        Relative PCA AUC value(s) of the signals. None, returned by pca_and_auc on errors, counts as NaN.
+    signal_type : string
+        The type of signal, either 'EEG' or 'ECG'.
+
+    Returns:
+    -------
+    levels : int or nd-array
+        Number of thresholds strictly exceeded, at least 1 (NaN values get 1), as in pca_classify.
+    """
+    rel_PCA_AUC = np.asarray(rel_PCA_AUC, dtype=np.float64)
+    thresholds = np.sort(PCA_THRESHOLDS.get(signal_type.lower(), []))
+    levels = np.maximum(np.searchsorted(thresholds, rel_PCA_AUC, side='left'), 1)
+    return np.where(np.isnan(rel_PCA_AUC), 1, levels)
 
 
-##### PCA noise analysis #####
 def pca_classify(signal, sampling_rate, signal_type):
     """
     -----
@@ -355,26 +431,39 @@ def pca_classify(signal, sampling_rate, signal_type):
         Level 1 - Poor Quality if rel_pca <= 0.60.
     """
     rel_PCA_AUC = pca_and_auc(signal, sampling_rate)
-    thresholds = [] # avoiding thresholds referenced before assignment warning
-
-    # Classification based on PCA relative AUC
-    # Define thresholds for classification based on signal type
-    if signal_type.lower() == 'eeg':
-        thresholds = [0.90, 0.7519, 0.6211]
-    elif signal_type.lower() == 'ecg':
-        thresholds = [0.8679, 0.7698, 0.60]
-
-    # Determine classification based on thresholds
-    for i, threshold in enumerate(thresholds):
-        if rel_PCA_AUC > threshold:
-            c = len(thresholds) - i
-            break
-    else:
-        c = 1
+    # Classification based on PCA relative AUC, with thresholds depending on the signal type
+    c = int(pca_levels(rel_PCA_AUC, signal_type))
     return c
 
 
 #### SNR ####
+# SNR in dB above which each quality level is reached
+SNR_THRESHOLDS = [5, 1, -5]
+
+
+def snr_levels(snr):
+    """
+    -----
+    Brief
+    -----
+    Grades SNR values against the SNR threshold ladder, for a single value or a whole array.
+    ----------
+    Parameters
+    ----------
+    snr : float or nd-array
+        SNR value(s) in dB.
+
+    Returns:
+    -------
+    levels : int or nd-array
+        1 plus the number of thresholds strictly exceeded. Values equal to a threshold, and NaN, get level 1,
+        as in snr_classify (its intervals are open).
+    """
+    thresholds = np.sort(SNR_THRESHOLDS)
+    levels = 1 + np.searchsorted(thresholds, snr, side='left')
+    return np.where(np.isnan(snr) | np.isin(snr, thresholds), 1, levels)
+
+
 def snr_classify(signal):
     """
     -----
@@ -402,23 +491,46 @@ def snr_classify(signal):
 
     snr = calculate_snr(signal)
     # Categorize SNR into four levels
-    if snr > 5:
-        quality = 'Level 4 - Excellent Quality (> 5 dB)'
-        values = 4
-    elif 5 > snr > 1:
-        quality = 'Level 3 - Good Quality (1 to 5 dB)'
-        values = 3
-    elif 1 > snr > -5:
-        quality = 'Level 2 - Moderate Quality (-5 to 1 dB)'
-        values = 2
-    else:
-        quality = 'Level 1 - Poor Quality (≤ -5 dB)'
-        values = 1
-
+    values = int(snr_levels(snr))
     return values
 
 
+# Tolerance below the maximum amplitude within which a sample counts as saturated
+SATURATION_THRESHOLDS = {'eeg': 1e-6,
+                         'ecg': 15}
+
+
 # Classification based on the length of the saturation segments
+def saturation_levels(total_saturation_duration, signal_duration):
+    """
+    -----
+    Brief
+    -----
+    Grades saturation durations against the 25%, 50% and 75% of the signal duration, for a single value or a
+    whole array.
+    ----------
+    Parameters
+    ----------
+    total_saturation_duration : float or nd-array
+        Duration(s) of saturated signal in seconds.
+    signal_duration : float or nd-array
+        Duration(s) of the signals in seconds.
+
+    Returns:
+    -------
+    levels : int or nd-array
+        4 minus the number of fractions of the signal duration reached, as in saturation_classify. NaN
+        durations get level 1.
+    """
+    total_saturation_duration = np.asarray(total_saturation_duration, dtype=np.float64)
+    signal_duration = np.asarray(signal_duration, dtype=np.float64)
+    # The edges are relative to each signal's duration, so they are compared directly instead of searchsorted
+    reached = ((total_saturation_duration >= signal_duration / 4).astype(int)
+               + (total_saturation_duration >= signal_duration / 2)
+               + (total_saturation_duration >= (signal_duration * 3) / 4))
+    return np.where(np.isnan(total_saturation_duration), 1, 4 - reached)
+
+
 def saturation_classify(signal, sampling_rate, signal_type):
     """
     -----
@@ -446,28 +558,43 @@ def saturation_classify(signal, sampling_rate, signal_type):
         Level 1 - Poor Quality. if saturation is more than 75% of the signal duration.
     """
 
-    if signal_type.lower() == 'eeg':
-        # Thresholds for 50 Hz noise amplitude in EEG
-        th = 1e-6
-
-    elif signal_type.lower() == 'ecg':
-        # Thresholds for 50 Hz noise amplitude in ECG
-        th = 15
-
+    th = SATURATION_THRESHOLDS[signal_type.lower()]
     total_saturation_duration = saturation(signal, sampling_rate, th)
     signal_duration = len(signal) / sampling_rate
-    if total_saturation_duration < signal_duration / 4:
-        c = 4
-    elif signal_duration / 4 <= total_saturation_duration < signal_duration / 2:
-        c = 3
-    elif signal_duration / 2 <= total_saturation_duration < (signal_duration * 3) / 4:
-        c = 2
-    else:
-        c = 1
-
+    c = int(saturation_levels(total_saturation_duration, signal_duration))
     return c
 
 
+# 50 Hz noise amplitude of each quality level, defined based on SNR quality levels for each signal
+POWER_LINE_THRESHOLDS = {'eeg': [0.843, 1.325, 2.660],
+                         'ecg': [0.189, 0.469, 1.055]}
+
+
+def power_line_levels(amplitude_50hz, signal_type='EEG'):
+    """
+    -----
+    Brief
+    -----
+    Grades 50 Hz noise amplitudes against the powerline threshold ladder, for a single value or a whole array.
+    ----------
+    Parameters
+    ----------
+    amplitude_50hz : float or nd-array
+        50 Hz noise amplitude(s) of the signals.
+    signal_type : string
+        The type of signal, either 'EEG' or 'ECG'.
+
+    Returns:
+    -------
+    levels : int or nd-array
+        len(thresholds) up to the first threshold (included), one level less past each following threshold,
+        and at least 1, as in power_line_classify. NaN amplitudes (not measurable) are graded 1.
+    """
+    thresholds = np.sort(POWER_LINE_THRESHOLDS.get(signal_type.lower(), []))
+    levels = len(thresholds) - np.searchsorted(thresholds, amplitude_50hz, side='left')
+    return np.maximum(levels, 1)
+
+
 def power_line_classify(signal, sampling_rate, signal_type):
     """
     -----
@@ -506,26 +633,8 @@ def power_line_classify(signal, sampling_rate, signal_type):
     *These thresholds were defined based on SNR quality levels for each signal.
     """
     amplitude_50hz = power_line_noise(signal, sampling_rate)
-    # Set thresholds based on signal type
-    if signal_type.lower() == 'eeg':
-        # Thresholds for 50 Hz noise amplitude in EEG
-        thresholds = [0.843, 1.325, 2.660]
-
-    elif signal_type.lower() == 'ecg':
-        # Thresholds for 50 Hz noise amplitude in ECG
-        thresholds = [0.189, 0.469, 1.055]
-
-    # Classify the quality based on 50 Hz noise amplitude
-    # Initialize classification value
-    c = 0
-
-    # Determine classification based on thresholds
-    for i, threshold in enumerate(thresholds):
-        if amplitude_50hz <= threshold:
-            c = len(thresholds) - i
-            break
-    else:
-        c = 1
+    # Classify the quality based on 50 Hz noise amplitude, with thresholds depending on the signal type
+    c = int(power_line_levels(amplitude_50hz, signal_type))
     return c
 
 
@@ -553,8 +662,7 @@ def binarize(values, lower_bound):
 
     # Checking what is the type of input
     if isinstance(values, (np.ndarray, list)):
-        values = np.array(values)  # Ensure values is an np.ndarray
-        mask = (values >= lower_bound).astype(int).tolist()
+        mask = binarize_array(values, lower_bound).astype(int).tolist()
     elif isinstance(values, (int, float, np.number)):
         mask = [1] if values >= lower_bound else [0]
     else:
@@ -563,6 +671,28 @@ def binarize(values, lower_bound):
     return mask
 
 
+def binarize_array(values, lower_bound):
+    """
+    -----
+    Brief :
+    -----
+    Vectorized binarize: the mask of a whole array of results (e.g. a metric over a cohort) in one comparison.
+    ----------
+    Parameters :
+    ----------
+    values : nd-array or list
+        Results with which to create the mask. NaN values are not included.
+    lower_bound : int or float
+        Minimum value of the results to be accepted in the mask.
+
+    Returns :
+    -------
+    mask : nd-array
+         uint8 mask of the signals that will be included: 1: included, 0: not included.
+    """
+    return (np.asarray(values) >= lower_bound).astype(np.uint8)
+
+
 ##### Application of functions to every dictionary #####
 def apply_function_to_timeseries(signal, func, *args, **kwargs):
     """
@@ -573,7 +703,7 @@ def apply_function_to_timeseries(signal, func, *args, **kwargs):
     ----------
     Parameters
     ----------
-    signal : dict or list or numpy.ndarray
+    signal : dict or list or numpy.ndarray or ChannelHandle
         Input data structure to be processed.
     func : function
         Function to be applied to each element of the data structure.
@@ -590,9 +720,13 @@ def apply_function_to_timeseries(signal, func, *args, **kwargs):
     if isinstance(signal, dict):
         # Recurse into the dictionary
         return {key: apply_function_to_timeseries(value, func, *args, **kwargs) for key, value in signal.items()}
+    elif isinstance(signal, ChannelHandle):
+        # Lazy channels are only read from disk here, when the function needs their samples
+        return apply_function_to_timeseries(np.asarray(signal), func, *args, **kwargs)
     elif isinstance(signal, (list, np.ndarray)):
-        # Apply the function to each element if it's a list or array
-        if all(isinstance(x, (int, float, np.number)) for x in signal):
+        # Apply the function to each element if it's a list or array.
+        # 1D arrays and lists of numbers are time series, checked in O(1) without scanning the samples.
+        if is_leaf(signal):
             # It's a numerical array, apply func with additional arguments
             return func(signal, *args, **kwargs)
         else:
@@ -650,7 +784,7 @@ def results_plot(results, b, n, m, c):
 
 
 ### Visualization of all the maps ###
-def metric_map_visualizer(data_dict, sr, signal_type):
+def metric_map_visualizer(data_dict, sr, signal_type, n_jobs=1, executor=None):
     """
     -----
     Brief
@@ -667,84 +801,149 @@ def metric_map_visualizer(data_dict, sr, signal_type):
         Name of the metric that should appear in the plot.
     signal_type : string
         Which signal is being analysed 'EEG' or 'ECG'.
+    n_jobs : int
+        Number of processes the channels are split across. -1 uses every core. Default: 1.
+    executor : concurrent.futures.Executor
+        Already running pool to dispatch the channels to, instead of starting one. Default: None.
     """
-    # Computing all the metrics for the data dictionary
-    # QCOD_dict = apply_function_to_timeseries(dict, uniqueness_classify, sr = sr, type = signal)
-    completeness_dict = apply_function_to_timeseries(data_dict, completeness_classify)
-    uniqueness_dict = apply_function_to_timeseries(data_dict, uniqueness_classify)
-    # hurst_dict = apply_function_to_timeseries(dict, hurst_classify)
-    amplitude_dict = apply_function_to_timeseries(data_dict, classify_amplitude, type=signal_type)
-    # pca_dict = apply_function_to_timeseries(dict, pca_classify, sampling_rate = sr, type = signal)
-    snr_dict = apply_function_to_timeseries(data_dict, snr_classify)
-    sat_dict = apply_function_to_timeseries(data_dict, saturation_classify, sampling_rate=sr, type=signal_type)
-    pwl_dict = apply_function_to_timeseries(data_dict, power_line_classify, sampling_rate=sr, type=signal_type)
+    # Computing all the metrics for the data dictionary in a single traversal
+    # ('QCOD', 'Hurst' and 'PCA' can be added to the list to plot them too)
+    results, _ = evaluate_quality(data_dict, dict.fromkeys(['Completeness', 'Uniqueness', 'Amplitude', 'SNR',
+                                                            'Saturation', 'Powerline']),
+                                  fs=sr, signal_type=signal_type, n_jobs=n_jobs, executor=executor)
 
     # Plotting the results
-    # results_plot(QCOD_dict, [0,4],'QCOD',1,["red", "yellow", "green"])
-    results_plot(completeness_dict, [0, 80, 85, 90, 95, 100], 'Completness (%) ', 0, ["red", "yellow", "green"])
-    results_plot(uniqueness_dict, [0, 70, 80, 90, 95, 100], 'Uniqueness (%) ', 0, ["red", "yellow", "green"])
-    # results_plot(hurst_dict[0, 1.5], 'Hurst Exponent', 1, ["blue", "white", "red", "brown"])
-    results_plot(amplitude_dict, [1, 4], 'Amplitude Quality ', 1, ["red", "yellow", "green"])
-    # results_plot(pca_dict, [1, 4], 'PCA Quality', 1, ["red", "yellow", "green"])
-    results_plot(snr_dict, [1, 4], 'SNR Quality ', 1, ["red", "yellow", "green"])
-    results_plot(sat_dict, [1, 4], 'Saturation Quality ', 1, ["red", "yellow", "green"])
-    results_plot(pwl_dict, [1, 4], 'Powerline noise Quality ', 1, ["red", "yellow", "green"])
+    # results_plot(results['QCOD'], [0,4],'QCOD',1,["red", "yellow", "green"])
+    results_plot(results['Completeness'], [0, 80, 85, 90, 95, 100], 'Completness (%) ', 0, ["red", "yellow", "green"])
+    results_plot(results['Uniqueness'], [0, 70, 80, 90, 95, 100], 'Uniqueness (%) ', 0, ["red", "yellow", "green"])
+    # results_plot(results['Hurst'], [0, 1.5], 'Hurst Exponent', 1, ["blue", "white", "red", "brown"])
+    results_plot(results['Amplitude'], [1, 4], 'Amplitude Quality ', 1, ["red", "yellow", "green"])
+    # results_plot(results['PCA'], [1, 4], 'PCA Quality', 1, ["red", "yellow", "green"])
+    results_plot(results['SNR'], [1, 4], 'SNR Quality ', 1, ["red", "yellow", "green"])
+    results_plot(results['Saturation'], [1, 4], 'Saturation Quality ', 1, ["red", "yellow", "green"])
+    results_plot(results['Powerline'], [1, 4], 'Powerline noise Quality ', 1, ["red", "yellow", "green"])
 
 
 #### Combining the masks that will have the same structure as the input data ####
-def combine_nested_masks(masks):
+def combine_masks(masks):
+    """
+    -----
+    Brief:
+    -----
+    Combines the masks of several metrics, each stored as one bool or uint8 array aligned to the same channel
+    index (e.g. ChannelStore positions or nested_to_array order), with a single np.logical_and.reduce.
+    ----------
+    Parameters:
+    ----------
+    masks : list or dict
+        1D arrays of 1's and 0's, one per metric, or a dict of them. None masks are skipped.
+
+    Returns:
+    -------
+    combined : 1D-array
+        uint8 array, 1 where every mask is 1.
+    """
+    if isinstance(masks, dict):
+        masks = list(masks.values())
+    masks = [np.asarray(mask, dtype=bool) for mask in masks if mask is not None]
+    if len({mask.shape for mask in masks}) > 1:
+        raise ValueError(f"The masks are not aligned: shapes {[mask.shape for mask in masks]}.")
+    return np.logical_and.reduce(masks, axis=0).astype(np.uint8)
+
+
+def nested_to_array(nested):
+    """
+    -----
+    Brief:
+    -----
+    Collects the numeric leaves of a nested structure of results or masks (dicts and lists, as returned by
+    apply_function_to_timeseries and binarize) in a flat array, in traversal order. Structures obtained from the
+    same dataset give aligned arrays.
+    ----------
+    Parameters:
+    ----------
+    nested : dict or list
+        Nested results or masks.
+
+    Returns:
+    -------
+    values : 1D-array
+        The numeric leaves.
+    """
+    values = []
+
+    def collect(node):
+        if isinstance(node, dict):
+            for value in node.values():
+                collect(value)
+        elif isinstance(node, (list, np.ndarray)):
+            for item in node:
+                collect(item)
+        elif isinstance(node, (Number, np.number)):
+            values.append(node)
+
+    collect(nested)
+    return np.array(values)
+
+
+def array_to_nested(template, values):
+    """
+    -----
+    Brief:
+    -----
+    Optional nested view of a flat array: puts the values back into the structure of template, the inverse of
+    nested_to_array.
+    ----------
+    Parameters:
+    ----------
+    template : dict or list
+        Nested structure with as many numeric leaves as values, e.g. one of the combined masks.
+    values : 1D-array
+        Values in nested_to_array order.
+
+    Returns:
+    -------
+    nested : dict or list
+        Copy of template holding the values.
+    """
+    values = iter(values.tolist() if isinstance(values, np.ndarray) else values)
+
+    def fill(node):
+        if isinstance(node, dict):
+            return {key: fill(value) for key, value in node.items()}
+        if isinstance(node, (list, np.ndarray)):
+            return [fill(item) for item in node]
+        if isinstance(node, (Number, np.number)):
+            return next(values)
+        return node
+
+    return fill(template)
+
+
+def combine_nested_masks(masks, nested=True):
     """
     -----
     Brief:
     -----
-    Combine nested dictionary masks using bitwise AND operation recursively.
+    Combine nested dictionary masks with an AND operation: each mask is flattened once into an array aligned to
+    the channels (nested_to_array), the arrays are combined with a single np.logical_and.reduce (combine_masks)
+    and the result is put back into the nested layout.
     ----------
     Parameters:
     ----------
     masks : list
-        Dictionaries containing masks with values of 1's and 0's.
+        Dictionaries containing masks with values of 1's and 0's, obtained from the same dataset.
+    nested : bool
+        Return the nested view of the combined mask. If False, the flat uint8 array is returned. Default: True.
 
     Returns:
     -------
-    combine_dicts : dict
+    combine_dicts : dict or 1D-array
         Dictionary with the combination of all inputed masks.
     """
-
-    def combine_values(value1, value2):
-        # Checking if masks to combine are dictionaries
-        if isinstance(value1, dict) and isinstance(value2, dict):
-            return combine_dicts([value1, value2])
-        # Checking if the masks are lists
-        elif isinstance(value1, list) and isinstance(value2, list):
-            return combine_lists([value1, value2])
-        else:
-            return value1 & value2
-
-    def combine_dicts(dicts):
-        # Function to combine dictionaries
-        result = copy.deepcopy(dicts[0])
-        for d in dicts[1:]:
-            if d is not None:
-                for key, value in d.items():
-                    if key in result:
-                        result[key] = combine_values(result[key], value)
-                    else:
-                        result[key] = copy.deepcopy(value)
-        return result
-
-    def combine_lists(lists):
-        # Function to combine lists
-        result = copy.deepcopy(lists[0])
-        for lst in lists[1:]:
-            if lst is not None:
-                for i in range(len(lst)):
-                    if i < len(result):
-                        result[i] = combine_values(result[i], lst[i])
-                    else:
-                        result.append(copy.deepcopy(lst[i]))
-        return result
-
-    return combine_dicts(masks)
+    masks = [mask for mask in masks if mask is not None]
+    combined = combine_masks([nested_to_array(mask) for mask in masks])
+    return array_to_nested(masks[0], combined) if nested else combined
 
 
 #### Flatten the masks, so they can be plotted ####
@@ -817,9 +1016,228 @@ def plot_binary(results):
 
 
 
+#### One-pass quality evaluation ####
+# Metrics read from the fused amplitude / saturation / completeness / uniqueness kernel (fused_metrics)
+FUSED_METRICS = ('Completeness', 'Uniqueness', 'Amplitude', 'Saturation')
+
+# Batched classification of each metric, called as func(signals, fs, signal_type, fused) on a
+# (n_channels, n_samples) block of channels, fused being the output of fused_metrics on that block.
+# The PSD of QCOD is computed once per block, so it skips the spectral cache (and hashing the block).
+QUALITY_METRICS = {
+    'QCOD': lambda signals, fs, signal_type, fused: qcod_levels(
+        qcod_from_psd(welch(signals, fs, nperseg=(signals.shape[-1] // 2), axis=-1)[1]), signal_type),
+    'Completeness': lambda signals, fs, signal_type, fused: fused[2],
+    'Uniqueness': lambda signals, fs, signal_type, fused: fused[3],
+    'Hurst': lambda signals, fs, signal_type, fused: hurst_batch(signals),
+    'Amplitude': lambda signals, fs, signal_type, fused: amplitude_levels(fused[0], signal_type),
+    'PCA': lambda signals, fs, signal_type, fused: pca_levels(pca_auc_batch(signals, fs), signal_type),
+    'SNR': lambda signals, fs, signal_type, fused: snr_levels(snr_batch(signals)),
+    'Saturation': lambda signals, fs, signal_type, fused: saturation_levels(fused[1], signals.shape[-1] / fs),
+    'Powerline': lambda signals, fs, signal_type, fused: power_line_levels(power_line_noise(signals, fs),
+                                                                           signal_type),
+}
+
+
+def quality_batch(signals, metrics, fs=2048, signal_type='EEG', chunk_size=16):
+    """
+    -----
+    Brief
+    -----
+    Computes every requested metric on a block of channels of the same length with the batched kernels of
+    QualityMetrics, grades them with the threshold ladders (qcod_levels, amplitude_levels, ...) and binarizes
+    them. The block is processed chunk_size channels at a time, every metric running on a chunk while it is still
+    in cache, and amplitude, saturation, completeness and uniqueness share a single detrended copy of it.
+    ----------
+    Parameters
+    ----------
+    signals : nd-array
+        (n_channels, n_samples) block, e.g. from ChannelStore.blocks.
+    metrics : dict
+        Metric names (keys of QUALITY_METRICS) as keys and the lower bound of each mask as values. Metrics with a
+        None lower bound are computed but left out of the mask.
+    fs : float
+        The signals' sampling frequency in Hz.
+    signal_type : string
+        Which signal is being analysed 'EEG' or 'ECG'.
+    chunk_size : int
+        Number of channels processed at once. Default: 16.
+
+    Returns:
+    -------
+    table : nd-array
+        Structured array with one record per channel: the value of each metric, as the *_classify functions
+        return it, and the 'mask' field, 1 if the channel meets every lower bound and 0 otherwise.
+    """
+    signals = np.atleast_2d(signals)
+    names = [name for name in QUALITY_METRICS if name in metrics]
+    fused = None
+    # Scratch buffer of the fused kernel, shared by every chunk of the block
+    scratch = None
+    if any(name in metrics for name in FUSED_METRICS):
+        scratch = np.empty((min(chunk_size, len(signals)), signals.shape[-1]), dtype=np.float64)
+
+    columns = {name: [] for name in names}
+    for start in range(0, len(signals), chunk_size):
+        chunk = signals[start:start + chunk_size]
+        if scratch is not None:
+            fused = fused_metrics(chunk, fs, SATURATION_THRESHOLDS[signal_type.lower()], scratch=scratch[:len(chunk)])
+        for name in names:
+            columns[name].append(np.asarray(QUALITY_METRICS[name](chunk, fs, signal_type, fused)))
+    columns = {name: np.concatenate(values) for name, values in columns.items()}
+
+    # All ones when no metric has a lower bound
+    mask = combine_masks([np.ones(len(signals), dtype=np.uint8)] +
+                         [binarize_array(columns[name], lower_bound=metrics[name]) for name in names
+                          if metrics[name] is not None])
+    return np.rec.fromarrays(list(columns.values()) + [mask], names=names + ['mask'])
+
+
+def _nested_quality(store, table, metrics):
+    """Results per metric and mask of quality_batch tables in store order, put back into the dataset's shape."""
+    names = [name for name in QUALITY_METRICS if name in metrics]
+    # A store without channels has no table to read the fields from
+    columns = {name: table[name] if len(store) else [] for name in names + ['mask']}
+    return {name: store.to_nested(columns[name]) for name in names}, store.to_nested(columns['mask'])
+
+
+def evaluate_quality(dataset, metrics, fs=2048, signal_type='EEG', n_jobs=1, executor=None):
+    """
+    -----
+    Brief
+    -----
+    Computes all the requested metrics and their combined mask in a single traversal of the dataset, instead of
+    one apply_function_to_timeseries traversal per metric plus one per binarize. The channels are copied once
+    into a flat ChannelStore (float64), and each block of channels of the same length goes through the batched
+    kernels (quality_batch). The store holds a copy of the whole dataset, so the peak memory is about the
+    dataset plus its float64 copy; lazy ChannelHandles are read one at a time while the store is filled.
+    ----------
+    Parameters
+    ----------
+    dataset : dict or list
+        Dictionary with the signals to be analyzed.
+    metrics : dict
+        Metric names (keys of QUALITY_METRICS) as keys and the lower bound of each mask as values. Metrics with a
+        None lower bound are computed but left out of the mask.
+    fs : float
+        The signal's sampling frequency in Hz.
+    signal_type : string
+        Which signal is being analysed 'EEG' or 'ECG'.
+    n_jobs : int
+        Number of processes the channels are split across (see evaluate_quality_parallel). -1 uses every core.
+        Default: 1.
+    executor : concurrent.futures.Executor
+        Already running pool to dispatch the channels to, instead of starting one. Default: None.
+
+    Returns:
+    -------
+    results : dict
+        For each metric, its values with the structure apply_function_to_timeseries returns.
+    mask : dict
+        Combined mask of the metrics with a lower bound, with the same structure as the results: 1 (green) if the
+        time series meets every lower bound, 0 (red) otherwise.
+    """
+    if n_jobs != 1 or executor is not None:
+        return evaluate_quality_parallel(dataset, metrics, fs=fs, signal_type=signal_type, n_jobs=n_jobs,
+                                         executor=executor)
+    store = ChannelStore.from_nested(dataset)
+    table = store.map(quality_batch, metrics, fs, signal_type, batched=True)
+    return _nested_quality(store, table, metrics)
+
+
+def evaluate_quality_parallel(dataset, metrics, fs=2048, signal_type='EEG', n_jobs=-1, executor=None):
+    """
+    -----
+    Brief
+    -----
+    Parallel evaluate_quality: the channels are copied once into a flat ChannelStore backed by shared memory,
+    and slices of its blocks of equal-length channels are dispatched to a process pool. The workers read the
+    samples from the shared memory block, so the signals are never pickled, and run quality_batch on them. The
+    results are put back into the nested structure in order.
+    As in the serial path, the memory peak is the dataset plus its float64 copy (here in shared memory), and
+    the metrics are computed on float64 samples. Lazy ChannelHandles are read into the block one at a time.
+    Starting the pool and filling the block cost a fixed overhead, so small datasets are faster with n_jobs=1
+    (see Benchmarks.benchmark_parallel_quality).
+    ----------
+    Parameters
+    ----------
+    dataset : dict or list
+        Dictionary with the signals to be analyzed.
+    metrics : dict
+        Metric names (keys of QUALITY_METRICS) as keys and the lower bound of each mask as values. Metrics with a
+        None lower bound are computed but left out of the mask.
+    fs : float
+        The signal's sampling frequency in Hz.
+    signal_type : string
+        Which signal is being analysed 'EEG' or 'ECG'.
+    n_jobs : int
+        Number of worker processes. -1 uses every core. Default: -1.
+    executor : concurrent.futures.Executor
+        Already running pool to dispatch the channels to, instead of starting one. The channels are split
+        according to its number of workers, n_jobs being only used when the pool does not tell it. Default: None.
+
+    Returns:
+    -------
+    results : dict
+        For each metric, its values with the structure apply_function_to_timeseries returns.
+    mask : dict
+        Combined mask of the metrics with a lower bound, with the same structure as the results.
+    """
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    if executor is not None:
+        # ProcessPoolExecutor and ThreadPoolExecutor both keep their number of workers in _max_workers
+        n_jobs = getattr(executor, '_max_workers', None) or n_jobs
+    shared = None
+    store = None
+
+    def allocate(n_values):
+        nonlocal shared
+        shared = SharedMemory(create=True, size=max(n_values, 1) * 8)
+        return np.ndarray(n_values, dtype=np.float64, buffer=shared.buf)
+
+    try:
+        store = ChannelStore.from_nested(dataset, allocate=allocate)
+        # A few tasks per worker balance the load: every block of equal-length channels is cut into slices of at
+        # most rows_per_task channels, given as (offset of the first sample, n_channels, n_samples)
+        rows_per_task = max(-(-len(store) // (4 * n_jobs)), 1)
+        slices = [(store.offsets[row], min(rows_per_task, stop - row), block.shape[1])
+                  for start, stop, block in store.blocks() for row in range(start, stop, rows_per_task)]
+        tasks = [(shared.name, len(store.values), offset, n_rows, n_samples, metrics, fs, signal_type)
+                 for offset, n_rows, n_samples in slices]
+        pool = executor if executor is not None else ProcessPoolExecutor(max_workers=n_jobs)
+        try:
+            # map returns the slices in submission order, i.e. in store order
+            tables = list(pool.map(_quality_batch, *zip(*tasks))) if tasks else []
+        finally:
+            if executor is None:
+                pool.shutdown()
+    finally:
+        if store is not None:
+            # The views of the block must be released before closing it
+            store.values = None
+        if shared is not None:
+            # Unlinked first, so the block is freed even if a view is still alive and closing fails
+            shared.unlink()
+            shared.close()
+
+    return _nested_quality(store, np.concatenate(tables) if tables else None, metrics)
+
+
+def _quality_batch(block_name, n_values, offset, n_rows, n_samples, metrics, fs, signal_type):
+    """quality_batch of the n_rows channels of n_samples starting at offset in the flat shared memory block."""
+    block = SharedMemory(name=block_name)
+    try:
+        values = np.ndarray(n_values, dtype=np.float64, buffer=block.buf)
+        table = quality_batch(values[offset:offset + n_rows * n_samples].reshape(n_rows, n_samples), metrics,
+                              fs=fs, signal_type=signal_type)
+        del values
+    finally:
+        block.close()
+    return table
+
+
 #### Quality maps for the whole dataset and chosen metrics with specified levels of quality ####
 def dummy_quality(dataset, metrics={'QCOD': 4, 'Completeness': 95, 'Uniqueness': 95, 'Hurst': 0.9,
-                                    'SNR': 4}, signal_type='EEG', fs=2048):
+                                    'SNR': 4}, signal_type='EEG', fs=2048, n_jobs=1, executor=None):
     """
     -----
     Brief
@@ -838,6 +1256,10 @@ def dummy_quality(dataset, metrics={'QCOD': 4, 'Completeness': 95, 'Uniqueness':
         Which signal is being analysed 'EEG' or 'ECG'.
     fs: float
         The signal's sampling frequency in Hz.
+    n_jobs : int
+        Number of processes the channels are split across. -1 uses every core. Default: 1.
+    executor : concurrent.futures.Executor
+        Already running pool to dispatch the channels to, instead of starting one. Default: None.
 
     Returns:
     -------
@@ -845,96 +1267,46 @@ def dummy_quality(dataset, metrics={'QCOD': 4, 'Completeness': 95, 'Uniqueness':
         Array with the quality mask according to the specified metrics and quality level. 1 (green): the signal has enough
         quality according to the chosen parameters. 0 (red): the signal does not meet the specified quality standards.
     """
-    qcod_mask = None
-    c_mask = None
-    u_mask = None
-    h_mask = None
-    a_mask = None
-    pca_mask = None
-    snr_mask = None
-    sat_mask = None
-    pwl_mask = None
-
-    if 'QCOD' in metrics.keys():
-        qcod = apply_function_to_timeseries(dataset, noise_classify, fs=fs, type=signal_type)
-        qcod_mask = apply_function_to_timeseries(qcod, binarize, lower_bound=metrics['QCOD'])
-        print('QCOD')
-
-    if 'Completeness' in metrics.keys():
-        c = apply_function_to_timeseries(dataset, completeness_classify)
-        c_mask = apply_function_to_timeseries(c, binarize, lower_bound=metrics['Completeness'])
-        print('Completeness')
-
-    if 'Uniqueness' in metrics.keys():
-        u = apply_function_to_timeseries(dataset, uniqueness_classify)
-        u_mask = apply_function_to_timeseries(u, binarize, lower_bound=metrics['Uniqueness'])
-        print('Uniqueness')
-
-    if 'Hurst' in metrics.keys():
-        h = apply_function_to_timeseries(dataset, hurst_classify)
-        h_mask = apply_function_to_timeseries(h, binarize, lower_bound=metrics['Hurst'])
-        print('Hurst')
-
-    if 'Amplitude' in metrics.keys():
-        a = apply_function_to_timeseries(dataset, classify_amplitude, type=signal_type)
-        a_mask = apply_function_to_timeseries(a, binarize, lower_bound=metrics['Amplitude'])
-        print('Amplitude')
-
-    if 'PCA' in metrics.keys():
-        pca = apply_function_to_timeseries(dataset, pca_classify, sampling_rate=fs, type=signal_type)
-        pca_mask = apply_function_to_timeseries(pca, binarize, lower_bound=metrics['PCA'])
-        print('PCA')
-
-    if 'SNR' in metrics.keys():
-        snr = apply_function_to_timeseries(dataset, snr_classify)
-        snr_mask = apply_function_to_timeseries(snr, binarize, lower_bound=metrics['SNR'])
-        print('SNR')
-
-    if 'Saturation' in metrics.keys():
-        sat = apply_function_to_timeseries(dataset, saturation_classify, sampling_rate=fs, type=signal_type)
-        sat_mask = apply_function_to_timeseries(sat, binarize, lower_bound=metrics['Saturation'])
-        print('Saturation')
-
-    if 'Powerline' in metrics.keys():
-        pwl = apply_function_to_timeseries(dataset, power_line_classify, sampling_rate=fs, type=signal_type)
-        pwl_mask = apply_function_to_timeseries(pwl, binarize, lower_bound=metrics['Powerline'])
-        print('Powerline Noise')
-
-    # Combine all masks
-    print('start combining')
-    masks = [qcod_mask, c_mask, u_mask, h_mask, a_mask, pca_mask, snr_mask, sat_mask, pwl_mask]
-    # Combining only not None masks
-    masks = [m for m in masks if m is not None]
-    final_mask = combine_nested_masks(masks)
+    # All the metrics are computed and binarized in a single traversal of the dataset
+    _, final_mask = evaluate_quality(dataset, metrics, fs=fs, signal_type=signal_type, n_jobs=n_jobs,
+                                     executor=executor)
+    print(', '.join(name for name in QUALITY_METRICS if name in metrics))
     # Plotting the combined masks
     plot_binary(final_mask)
     return final_mask
 
-### Checking the levels of quality for one metrics ###
-result_dict = apply_function_to_timeseries(data, power_line_classify, sampling_rate=2048, type='EEG')
-result_dict2 = apply_function_to_timeseries(data, saturation_classify, sampling_rate=2048, type='EEG')
-results_plot(result_dict, [1, 4], 'Powerline Noise', 1, ["red", "yellow", "green"])
 
-### Checking the levels of quality for all metrics ###
-metric_map_visualizer(data, 2048, 'EEG')
+if __name__ == '__main__':
+    # Importing data #
+    path = '/Users/Asus/AISYM4MED_1/UMC_data/UMC_data'
+    # Decoded sessions are kept in an HDF5 cache, so restarts only re-read the sessions whose files changed
+    data = structure_data(path, 'classifier', cache_path=os.path.join(path, 'UMC_data_cache.h5'))
+
+    ### Checking the levels of quality for one metrics ###
+    result_dict = apply_function_to_timeseries(data, power_line_classify, sampling_rate=2048, signal_type='EEG')
+    result_dict2 = apply_function_to_timeseries(data, saturation_classify, sampling_rate=2048, signal_type='EEG')
+    results_plot(result_dict, [1, 4], 'Powerline Noise', 1, ["red", "yellow", "green"])
+
+    ### Checking the levels of quality for all metrics ###
+    metric_map_visualizer(data, 2048, 'EEG')
 
-## Testing for a dictionary that would only have one value per key ##
-file_path = 'synthetic_data.pkl'
-data1 = pd.read_pickle(file_path)
-data1 = np.array(data1)
+    ## Testing for a dictionary that would only have one value per key ##
+    file_path = 'synthetic_data.pkl'
+    data1 = pd.read_pickle(file_path)
+    data1 = np.array(data1)
 
-### Testing for one value per key in the data dictionary ###
-dict1 = {}
-for i in range(0, len(data1)):
-    dict1[i] = data1[i]
+    ### Testing for one value per key in the data dictionary ###
+    dict1 = {}
+    for i in range(0, len(data1)):
+        dict1[i] = data1[i]
 
-result_dict1 = apply_function_to_timeseries(dict1, uniqueness_classify)
-## Plotting results for this case ##
-results_plot(result_dict1, [70, 80, 90, 95, 100], 'Uniqueness (%)', 0, ["red", "yellow", "green"])
+    result_dict1 = apply_function_to_timeseries(dict1, uniqueness_classify)
+    ## Plotting results for this case ##
+    results_plot(result_dict1, [70, 80, 90, 95, 100], 'Uniqueness (%)', 0, ["red", "yellow", "green"])
 
-## Usage for 1 metric
-b1 = apply_function_to_timeseries(result_dict, binarize, lower_bound=3)
-plot_binary(b1)
+    ## Usage for 1 metric
+    b1 = apply_function_to_timeseries(result_dict, binarize, lower_bound=3)
+    plot_binary(b1)
 
-## Usage for more than one metric
-sigs = dummy_quality(data, metrics={'Completeness': 95, 'Uniqueness': 95, 'Powerline': 3}, fs=2048, signal_type='EEG')
+    ## Usage for more than one metric
+    sigs = dummy_quality(data, metrics={'Completeness': 95, 'Uniqueness': 95, 'Powerline': 3}, fs=2048, signal_type='EEG')
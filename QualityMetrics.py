@@ -1,12 +1,11 @@
 ### Packages ###
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 import numpy as np
 from scipy.signal import welch
-import fathon
-from fathon import fathonUtils as fu
-from sklearn.decomposition import PCA
-from sklearn.metrics import auc
 from scipy.signal import detrend
-from scipy.fft import fft, fftfreq
+from SpectralCache import spectral_cache
 
 
 ######## QCoD metrics ########
@@ -38,17 +37,99 @@ def QCod(fs, thresh, signal):
         Power spectrum of timeseries.
     """
     # computing the spectral power density
-    f, psd = welch(signal, fs, nperseg=(len(signal) // 2))
+    f, psd = spectral_cache.welch(signal, fs, nperseg=(len(signal) // 2))
+    qcod = qcod_from_psd(psd)
+    mask = 1 if qcod >= thresh else 0
+    return mask, f, psd
+
+
+def qcod_from_psd(psd):
+    """
+    -----
+    Brief
+    -----
+    Computes the QCoD score from power spectral densities, along the last axis.
+    ----------
+    Parameters
+    ----------
+    psd : nd-array
+        Power spectrum of one timeseries, or (n_channels, n_freqs) power spectra.
+
+    Returns
+    -------
+    qcod : float or nd-array
+        (q1 - q3) / (q1 + q3), q1 and q3 being the power in the 1st and 3rd quartiles of the spectrum.
+    """
     # dividing psd into quartiles
-    psdquarters = int(round(len(psd)) / 4)
+    psdquarters = int(round(psd.shape[-1]) / 4)
     # Cumulative sum of the values in the 1st quartile
-    q1 = np.sum(psd[:psdquarters])
+    q1 = np.sum(psd[..., :psdquarters], axis=-1)
     # Cumulative sum of the values in the 3rd quartile
-    q3 = sum(psd[2 * psdquarters + 1:3 * psdquarters])
+    q3 = np.sum(psd[..., 2 * psdquarters + 1:3 * psdquarters], axis=-1)
 
-    qcod = (q1 - q3) / (q1 + q3)
-    mask = 1 if qcod >= thresh else 0
-    return mask, f, psd
+    return (q1 - q3) / (q1 + q3)
+
+
+def QCod_batch(fs, thresh, signals):
+    """
+    -----
+    Brief
+    -----
+    Batched QCod: the power spectral densities of all the signals are computed in a single Welch call along the
+    last axis, and the QCoD scores and masks are returned as vectors.
+    ----------
+    Parameters
+    ----------
+    fs : int
+        sampling frequency
+    thresh : float
+        maximum threshold acceptable for the presence of white noise in the PSD.
+    signals : nd-array
+        (n_channels, n_samples) array with signals of the same length.
+
+    Returns
+    -------
+    masks : nd-array
+        1 (not contaminated) or 0 (contaminated), per channel.
+    qcod : nd-array
+        QCoD score per channel.
+    f : 1D-array
+        Sampling frequencies.
+    psd : nd-array
+        (n_channels, n_freqs) power spectra.
+    """
+    qcod, f, psd = qcod_score(fs, signals)
+    masks = (qcod >= thresh).astype(int)
+    return masks, qcod, f, psd
+
+
+def qcod_score(fs, signals):
+    """
+    -----
+    Brief
+    -----
+    Computes the QCoD score of one signal or of a batch of signals, without thresholding it, so that the score
+    can be graded against several thresholds at once.
+    ----------
+    Parameters
+    ----------
+    fs : int
+        sampling frequency
+    signals : nd-array
+        1D signal or (n_channels, n_samples) array with signals of the same length.
+
+    Returns
+    -------
+    qcod : float or nd-array
+        QCoD score, per channel for a batch.
+    f : 1D-array
+        Sampling frequencies.
+    psd : nd-array
+        Power spectrum, per channel for a batch.
+    """
+    signals = np.asarray(signals)
+    f, psd = spectral_cache.welch(signals, fs, nperseg=(signals.shape[-1] // 2))
+    return qcod_from_psd(psd), f, psd
 
 
 ######## Completness metrics ########
@@ -102,9 +183,6 @@ def uniqueness(signal):
     # Ensure signal is a numpy array
     signal = np.asarray(signal)
 
-    # Initialize a list to store uniqueness percentages for each dimension
-    uniqueness_percentages = []
-
     # Check if the signal is multi-dimensional
     if signal.ndim == 1:
         # For 1D signal, simply compare each element to the next
@@ -112,8 +190,13 @@ def uniqueness(signal):
         total_comparisons = max(len(signal) - 1, 1)  # Avoid division by zero
         uniqueness_percentage = (unique_consecutive / total_comparisons) * 100
         return uniqueness_percentage
+    elif signal.ndim == 2:
+        # For 2D signals, every dimension (column) is compared along the samples in one pass
+        uniqueness_percentages, average_uniqueness = uniqueness_batch(signal, axis=0)
+        return average_uniqueness
     else:
-        # For multi-dimensional signals, iterate over dimensions
+        # For higher dimensions, every dimension of axis 1 counts the changes of its whole sub-array
+        uniqueness_percentages = []
         for dim in range(signal.shape[1]):
             unique_consecutive = np.sum(signal[:-1, dim] != signal[1:, dim])
             total_comparisons = max(signal.shape[0] - 1, 1)  # Avoid division by zero
@@ -124,6 +207,41 @@ def uniqueness(signal):
         return average_uniqueness
 
 
+def uniqueness_batch(signals, axis=-1):
+    """
+    -----
+    Brief
+    -----
+    Vectorized uniqueness: the percentage of consecutive unique values of every channel, computed along the
+    chosen axis in a single pass.
+    ----------
+    Parameters:
+    ----------
+    signals: nd-array or list
+        Batch of signals, e.g. (n_channels, n_samples).
+    axis : int
+        Axis along which the samples are ordered. Default: -1 (channels in rows).
+
+    Returns:
+    -------
+    uniqueness_percentages : nd-array
+        Uniqueness percentage per channel (every axis but the chosen one).
+    average_uniqueness : float
+        Average uniqueness percentage across channels.
+    """
+    signals = np.asarray(signals)
+    n_samples = signals.shape[axis]
+    # Comparing each element to the next along the axis
+    lead = [slice(None)] * signals.ndim
+    lead[axis] = slice(None, -1)
+    tail = [slice(None)] * signals.ndim
+    tail[axis] = slice(1, None)
+    unique_consecutive = np.count_nonzero(signals[tuple(lead)] != signals[tuple(tail)], axis=axis)
+    total_comparisons = max(n_samples - 1, 1)  # Avoid division by zero
+    uniqueness_percentages = (unique_consecutive / total_comparisons) * 100
+    return uniqueness_percentages, np.mean(uniqueness_percentages)
+
+
 ######## Hurst Exponent analysis ########
 def hurst_exponent(signal):
     """
@@ -142,16 +260,126 @@ def hurst_exponent(signal):
     H : float
         Value of the Hurst exponent.
     """
-    # zero - mean cumulative sum
-    a = fu.toAggregated(signal)
-    # Initialize the dfa object
-    pydcca = fathon.DFA(a)
-    polOrd = 1
-    # compute fluctuation function
-    winSizes = fu.linRangeByStep(16, len(signal) / 8, step=50)
-    n, F = pydcca.computeFlucVec(winSizes, polOrd=polOrd)
-    # compute the Hurst exponent
-    H, _ = pydcca.fitFlucVec()
+    # Same DFA as fathon.DFA (polOrd=1, window sizes fu.linRangeByStep(16, len(signal) / 8, step=50))
+    H = hurst_batch(np.asarray(signal, dtype=np.float64)[np.newaxis])
+    return float(H[0])
+
+
+@lru_cache(maxsize=32)
+def dfa_grid(n_samples):
+    """
+    -----
+    Brief
+    -----
+    Window sizes and linear-detrending regressors of the DFA of signals with n_samples samples. The grid only
+    depends on the length of the signals, so it is computed once and shared by every channel of that length.
+    ----------
+    Parameters
+    ----------
+    n_samples : int
+        Length of the signals.
+
+    Returns:
+    -------
+    grid : tuple
+        (window_size, centered sample index, sum of its squares) for each window size of
+        fu.linRangeByStep(16, n_samples / 8, step=50).
+    """
+    grid = []
+    for window_size in np.arange(16, n_samples / 8 + 1, 50, dtype=np.int64):
+        x = np.arange(window_size) - (window_size - 1) / 2
+        x.flags.writeable = False
+        grid.append((int(window_size), x, float(x @ x)))
+    return tuple(grid)
+
+
+def dfa_fluctuations(signals, chunk_size=16):
+    """
+    -----
+    Brief
+    -----
+    Computes the first order DFA fluctuation function of a batch of signals, the same values as fathon's
+    DFA.computeFlucVec(winSizes, polOrd=1) on each signal's profile. For every window size the profiles of all
+    the channels are cut into non-overlapping windows at once, and the residual variance of the least squares
+    line of each window is obtained in closed form, without fitting each window separately.
+    ----------
+    Parameters
+    ----------
+    signals : nd-array
+        (n_channels, n_samples) array with signals of the same length.
+    chunk_size : int
+        Number of channels detrended at once, bounding the scratch memory to chunk_size * n_samples values.
+        Default: 16.
+
+    Returns:
+    -------
+    window_sizes : 1D-array
+        Window sizes n of the fluctuation function.
+    F : nd-array
+        (n_channels, n_window_sizes) fluctuation function F(n).
+    """
+    signals = np.asarray(signals, dtype=np.float64)
+    n_samples = signals.shape[-1]
+    grid = dfa_grid(n_samples)
+    F = np.empty((signals.shape[0], len(grid)))
+
+    for start in range(0, signals.shape[0], chunk_size):
+        # zero - mean cumulative sum (fu.toAggregated)
+        profile = signals[start:start + chunk_size]
+        profile = np.cumsum(profile - profile.mean(axis=-1, keepdims=True), axis=-1)
+        for i, (window_size, x, x_squares) in enumerate(grid):
+            n_windows = n_samples // window_size
+            windows = profile[:, :n_windows * window_size].reshape(len(profile), n_windows, window_size)
+            windows = windows - windows.mean(axis=-1, keepdims=True)
+            # Residual sum of squares of the linear fit: Syy - Sxy^2 / Sxx
+            residuals = np.einsum('cwn,cwn->c', windows, windows) - np.sum((windows @ x) ** 2, axis=-1) / x_squares
+            F[start:start + chunk_size, i] = np.sqrt(np.maximum(residuals, 0) / (n_windows * window_size))
+    return np.array([window_size for window_size, _, _ in grid]), F
+
+
+def hurst_batch(signals, n_jobs=1, chunk_size=16):
+    """
+    -----
+    Brief
+    -----
+    Computes the Hurst exponent of a batch of signals with the batched DFA (dfa_fluctuations), fitting all the
+    log F(n) vs log n lines at once. It matches the H of fathon.DFA up to floating point rounding.
+    ----------
+    Parameters
+    ----------
+    signals : nd-array
+        (n_channels, n_samples) array with signals of the same length.
+    n_jobs : int
+        Number of processes the channels are split across. -1 uses every core. Default: 1.
+    chunk_size : int
+        Number of channels detrended at once by each process. Default: 16.
+
+    Returns:
+    -------
+    H : 1D-array
+        Hurst exponent per channel. NaN for flat signals and for signals with fewer than two window sizes (fewer
+        than 521 samples), where fathon raises an error.
+    """
+    signals = np.asarray(signals, dtype=np.float64)
+    if len(dfa_grid(signals.shape[-1])) < 2:
+        # No line to fit
+        return np.full(signals.shape[:-1], np.nan)
+    if n_jobs == 1 or len(signals) <= chunk_size:
+        window_sizes, F = dfa_fluctuations(signals, chunk_size=chunk_size)
+    else:
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        blocks = np.array_split(signals, min(n_jobs, -(-len(signals) // chunk_size)))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(partial(dfa_fluctuations, chunk_size=chunk_size), blocks))
+        window_sizes = results[0][0]
+        F = np.concatenate([block_F for _, block_F in results])
+
+    # Slope of the least squares line of log F(n) vs log n, for every channel
+    log_n = np.log(window_sizes)
+    log_n = log_n - log_n.mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_F = np.log(F)
+        H = (log_F - log_F.mean(axis=-1, keepdims=True)) @ log_n / (log_n @ log_n)
     return H
 
 
@@ -192,7 +420,7 @@ def pca_and_auc(data, sampling_rate):
     Parameters
     ----------
     data : nd-array
-        array with the signal to be analyzed.
+        array with the signal to be analyzed, 1D or a single (1, n_samples) channel.
     sampling_rate : int
         signal's sampling frequency in Hz.
     Returns:
@@ -206,37 +434,135 @@ def pca_and_auc(data, sampling_rate):
         if not isinstance(data, np.ndarray) or data.size == 0:
             return print("Invalid data: Data should be a non-empty numpy array.")
 
-        # Calculate the length of the data in seconds
-        len_data_seconds = len(data) / sampling_rate
+        rel_PCA_AUC = pca_auc_batch(data.reshape(-1, data.shape[-1]), sampling_rate)
+        return float(rel_PCA_AUC[0]) if len(rel_PCA_AUC) == 1 else rel_PCA_AUC
 
-        # Reshape the data for PCA
-        data = data.reshape(int(-len_data_seconds), int(len_data_seconds))
-
-        # Apply PCA to the data
-        pca = PCA()
-        pca.fit(data)
+    except Exception as e:
+        print(f"An error occurred: {e}")
 
-        # Calculate the cumulative variance explained by the principal components
-        cumulative_variance = np.cumsum(pca.explained_variance_ratio_)
-        num_components = np.arange(len(cumulative_variance))
 
-        # Calculate the area under the cumulative variance curve
-        area_under_curve = auc(num_components, cumulative_variance)
+def pca_auc_batch(signals, sampling_rate, method='covariance', chunk_size=16, block_rows=256):
+    """
+    -----
+    Brief
+    -----
+    Batched PCA-AUC: the relative area under the cumulative explained variance curve of every channel, the same
+    value as pca_and_auc. Each signal of n seconds is laid out as a (n_samples / n, n) matrix (row r holds
+    samples r * n to r * n + n - 1), as the sklearn PCA version did. The explained variances are the eigenvalues
+    of the covariance matrices of a block of channels, obtained with one batched np.linalg.eigvalsh call, using
+    the smaller of the covariance and Gram matrices.
+    Trailing samples that do not fill a row are dropped, where the old reshape failed.
+    ----------
+    Parameters
+    ----------
+    signals : nd-array
+        1D signal or (n_channels, n_samples) signals.
+    sampling_rate : int
+        signal's sampling frequency in Hz.
+    method : string
+        'covariance' centers each channel matrix in memory. 'incremental' accumulates the covariance matrix over
+        blocks of block_rows rows, so long recordings (or memmaps) are never copied whole. Default: 'covariance'.
+    chunk_size : int
+        Number of channels processed at once. Default: 16.
+    block_rows : int
+        Rows per block of the 'incremental' method. Default: 256.
+    Returns:
+    -------
+    rel_PCA_AUC : 1D-array
+        Relative PCA AUC per channel. NaN for channels shorter than one second or with NaN or inf values.
+    """
+    if method not in ('covariance', 'incremental'):
+        raise ValueError(f"Unknown method '{method}', expected 'covariance' or 'incremental'.")
+    signals = np.atleast_2d(np.asarray(signals))
+    n_channels, n_samples = signals.shape
+    rel_PCA_AUC = np.full(n_channels, np.nan)
+
+    # Matrix layout of each channel: n_rows x n_columns, with as many columns as seconds
+    n_columns = int(n_samples / sampling_rate)
+    if n_columns < 1:
+        return rel_PCA_AUC
+    n_rows = n_samples // n_columns
+    n_components = min(n_rows, n_columns)
+
+    for start in range(0, n_channels, chunk_size):
+        block = signals[start:start + chunk_size, :n_rows * n_columns]
+        if method == 'covariance':
+            matrices = np.array(block, dtype=np.float64).reshape(len(block), n_rows, n_columns)
+            matrices -= matrices.mean(axis=1, keepdims=True)
+            if n_columns <= n_rows:
+                covariance = np.matmul(matrices.transpose(0, 2, 1), matrices)
+            else:
+                # Gram matrix: same non-zero eigenvalues, smaller when there are fewer rows than columns
+                covariance = np.matmul(matrices, matrices.transpose(0, 2, 1))
+        else:
+            covariance = _incremental_covariance(block, n_rows, n_columns, block_rows)
+
+        valid = np.isfinite(np.einsum('cii->c', covariance))
+        covariance[~valid] = 0
+        # Explained variances in decreasing order, as sklearn's PCA keeps min(n_rows, n_columns) components
+        variances = np.clip(np.linalg.eigvalsh(covariance)[:, ::-1][:, :n_components], 0, None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cumulative_variance = np.cumsum(variances, axis=-1) / np.einsum('cii->c', covariance)[:, np.newaxis]
+        # Trapezoidal area under the curve over num_components = 0, 1, ..., divided by the maximum possible AUC
+        area_under_curve = (np.sum(cumulative_variance, axis=-1)
+                            - (cumulative_variance[:, 0] + cumulative_variance[:, -1]) / 2)
+        rel_PCA_AUC[start:start + chunk_size] = np.where(valid, area_under_curve / n_components, np.nan)
+    return rel_PCA_AUC
+
+
+def _incremental_covariance(block, n_rows, n_columns, block_rows):
+    """Centered cross-product matrix of each channel's (n_rows, n_columns) matrix, accumulated over row blocks."""
+    covariance = np.zeros((len(block), n_columns, n_columns))
+    column_sums = np.zeros((len(block), n_columns))
+    # Shifting by the first row keeps the accumulated sums small, avoiding cancellation when centering
+    shift = np.asarray(block[:, :n_columns], dtype=np.float64)[:, np.newaxis]
+    for row in range(0, n_rows, block_rows):
+        rows = min(block_rows, n_rows - row)
+        matrices = np.array(block[:, row * n_columns:(row + rows) * n_columns], dtype=np.float64)
+        matrices = matrices.reshape(len(block), rows, n_columns)
+        matrices -= shift
+        covariance += np.matmul(matrices.transpose(0, 2, 1), matrices)
+        column_sums += matrices.sum(axis=1)
+    covariance -= column_sums[:, :, np.newaxis] * column_sums[:, np.newaxis, :] / n_rows
+    return covariance
 
-        # Calculate the maximum possible AUC
-        max_possible_auc = len(cumulative_variance) * 1.0
 
-        # Calculate the relative PCA AUC
-        rel_PCA_AUC = area_under_curve / max_possible_auc
+##### SNR Classification #####
+@lru_cache(maxsize=8)
+def reference_rms(amplitude=1.5, frequency=5, fs=1000, duration=15):
+    """
+    -----
+    Brief
+    -----
+    Computes the RMS of the sinusoidal base signal the SNR is measured against. It is cached, so the base signal
+    is only generated once per set of parameters.
+    ----------
+    Parameters
+    ----------
+    amplitude : float
+        Amplitude of the base signal. Default: 1.5.
+    frequency : float
+        Frequency of the base signal in Hz. Default: 5.
+    fs : int
+        Sampling frequency of the base signal in Hz. Default: 1000.
+    duration : float
+        Duration of the base signal in seconds. Default: 15.
+    Returns:
+    -------
+    rms_base_signal : float
+        RMS of the base signal.
+    """
+    t = np.arange(0, duration, 1 / fs)
+    # Create a base EEG-like signal (for simplicity, a sinusoidal wave)
+    base_signal = amplitude * np.sin(2 * np.pi * frequency * t)
+    return float(np.sqrt(np.mean(base_signal ** 2)))
 
-        return rel_PCA_AUC
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+# RMS of the default base signal: a 15 seconds, 1000 Hz, 1.5 * sin(2 * pi * 5 * t) wave
+REFERENCE_RMS = reference_rms()
 
 
-##### SNR Classification #####
-def calculate_snr(data):
+def calculate_snr(data, rms_base_signal=REFERENCE_RMS):
     #todo i dont know if the base signal is only valid for EEG?
     """
     -----
@@ -248,30 +574,52 @@ def calculate_snr(data):
     ----------
     data : nd-array or list
         The input signal.
+    rms_base_signal : float
+        RMS of the base signal used for comparison (see reference_rms). Default: REFERENCE_RMS.
     Returns:
     -------
     snr : float
-        SNR in dB.
+        SNR in dB, inf for an all-zero signal and NaN for a signal with missing (NaN) samples.
     """
-
-    # Create a base signal for comparison
-    fs = 1000  # Sampling frequency in Hz
-    t = np.arange(0, 15, 1 / fs)  # 15 seconds duration
-    # Create a base EEG-like signal (for simplicity, a sinusoidal wave)
-    base_signal = 1.5 * np.sin(2 * np.pi * 5 * t)  # 5 Hz sine wave
-
-    # Calculate RMS of signal and noise
-    rms_base_signal = np.sqrt(np.mean(base_signal ** 2))
-    rms_noise = np.sqrt(np.mean(np.array(data) ** 2))
-    values = []
+    # Calculate RMS of noise
+    rms_noise = np.sqrt(np.mean(np.asarray(data) ** 2))
     # Calculate SNR
-    if rms_noise > 0:
+    if np.isnan(rms_noise):
+        snr = np.nan
+    elif rms_noise > 0:
         snr = 20 * np.log10(rms_base_signal / rms_noise)
     else:
         snr = np.inf
     return snr
 
 
+def snr_batch(signals, rms_base_signal=REFERENCE_RMS):
+    """
+    -----
+    Brief
+    -----
+    Computes the Signal to Noise Ratio (SNR) of every channel of a batch at once.
+    ----------
+    Parameters
+    ----------
+    signals : nd-array
+        (n_channels, n_samples) array with the signals.
+    rms_base_signal : float
+        RMS of the base signal used for comparison (see reference_rms). Default: REFERENCE_RMS.
+    Returns:
+    -------
+    snr : 1D-array
+        SNR in dB per channel, inf for all-zero channels and NaN for channels with missing (NaN) samples, as in
+        calculate_snr.
+    """
+    signals = np.asarray(signals, dtype=np.float64)
+    # Sum of squares per channel without allocating the squared signals
+    rms_noise = np.sqrt(np.einsum('...i,...i->...', signals, signals) / signals.shape[-1])
+    with np.errstate(divide='ignore'):
+        snr = 20 * np.log10(rms_base_signal / rms_noise)
+    return snr
+
+
 ##### Saturation ######
 def saturation(data, sampling_rate, th):
     """
@@ -332,6 +680,171 @@ def saturation(data, sampling_rate, th):
         print(f"An error occurred: {e}")
 
 
+##### Fused amplitude / saturation / completeness / uniqueness ######
+def fused_metrics(data, sampling_rate, th, scratch=None):
+    """
+    -----
+    Brief
+    -----
+    Computes amplitude, saturation, completeness and uniqueness together. The signal is copied once into a
+    scratch buffer and linearly detrended in place, so it is detrended only once for both amplitude and
+    saturation. Works on a single signal or on a batch of channels (along the last axis).
+    ----------
+    Parameters
+    ----------
+    data : nd-array or list
+        1D signal or (n_channels, n_samples) signals.
+    sampling_rate : int
+        The sampling rate of the signal in Hz.
+    th : float
+        The threshold to consider the maximum amplitude possible (see saturation).
+    scratch : nd-array
+        Optional float64 buffer with the shape of data, overwritten with the detrended signal. Passing the same
+        buffer for every channel of a dataset avoids allocating a new one per call. Default: None.
+
+    Returns:
+    -------
+    max_amplitude : float or nd-array
+        Maximum absolute amplitude of the detrended signal (amplitude). NaN if the signal has NaN or inf values.
+    total_saturation_duration : float or nd-array
+        Duration of saturated signal in seconds (saturation). NaN if the signal has NaN or inf values.
+    missing_percentage : float or nd-array
+        Percentage of missing values (completeness).
+    uniqueness_percentage : float or nd-array
+        Percentage of consecutive unique values (uniqueness).
+    """
+    data = np.asarray(data)
+    single = data.ndim == 1
+    data = np.atleast_2d(data)
+    if scratch is None:
+        scratch = np.empty(data.shape, dtype=np.float64)
+    scratch = np.atleast_2d(scratch)
+    np.copyto(scratch, data)
+
+    # Completeness and uniqueness are computed on the original values
+    missing_percentage = np.count_nonzero(np.isnan(scratch), axis=-1) / scratch.shape[-1] * 100
+    uniqueness_percentage, _ = uniqueness_batch(scratch)
+
+    # Non-finite channels cannot be detrended: they are zeroed and reported as NaN
+    invalid = ~np.isfinite(np.sum(scratch, axis=-1))
+    scratch[invalid] = 0
+    detrend(scratch, overwrite_data=True)
+
+    # Amplitude: maximum of the absolute detrended signal, without allocating np.abs of it
+    max_value = np.max(scratch, axis=-1)
+    max_amplitude = np.maximum(max_value, -np.min(scratch, axis=-1))
+
+    total_saturation_duration, _ = _detrended_saturation(scratch, max_value, sampling_rate, th)
+
+    max_amplitude[invalid] = np.nan
+    total_saturation_duration[invalid] = np.nan
+    if single:
+        return (float(max_amplitude[0]), float(total_saturation_duration[0]), float(missing_percentage[0]),
+                float(uniqueness_percentage[0]))
+    return max_amplitude, total_saturation_duration, missing_percentage, uniqueness_percentage
+
+
+def _detrended_saturation(detrended_signal, max_amplitude, sampling_rate, th):
+    """Total and longest saturation duration per row of a detrended block, which is overwritten."""
+    # Samples within th of the maximum, as np.isclose(detrended_signal, max_amplitude, atol=th)
+    np.subtract(max_amplitude[:, np.newaxis], detrended_signal, out=detrended_signal)
+    is_max_amplitude = detrended_signal <= (th + 1e-05 * np.abs(max_amplitude))[:, np.newaxis]
+    samples_needed_for_200ms = int(200 * sampling_rate / 1000)
+    saturated_samples, longest_run = saturation_runs(is_max_amplitude, samples_needed_for_200ms)
+    return saturated_samples / sampling_rate, longest_run / sampling_rate
+
+
+def saturation_runs(is_max_amplitude, min_length):
+    """
+    -----
+    Brief
+    -----
+    Run-length encoding of a block of boolean masks at once: finds every run of True values of every row in a
+    single np.diff over the block.
+    ----------
+    Parameters
+    ----------
+    is_max_amplitude : nd-array
+        (n_channels, n_samples) boolean array.
+    min_length : int
+        Minimum length, in samples, of the runs counted as saturated.
+
+    Returns:
+    -------
+    saturated_samples : 1D-array
+        Number of samples per row in runs at least min_length samples long.
+    longest_run : 1D-array
+        Length of the longest run per row, 0 if the row has no True value.
+    """
+    n_rows, n_samples = is_max_amplitude.shape
+    # Padding with False on both ends makes every run start with +1 and end with -1
+    padded = np.zeros((n_rows, n_samples + 2), dtype=np.int8)
+    padded[:, 1:-1] = is_max_amplitude
+    changes = np.diff(padded, axis=-1)
+    # np.nonzero is row-major, so the i-th start and the i-th end belong to the same run
+    rows, segment_starts = np.nonzero(changes == 1)
+    _, segment_ends = np.nonzero(changes == -1)
+    segment_lengths = segment_ends - segment_starts
+
+    long_segments = segment_lengths >= min_length
+    saturated_samples = np.bincount(rows[long_segments], weights=segment_lengths[long_segments], minlength=n_rows)
+    longest_run = np.zeros(n_rows, dtype=np.int64)
+    np.maximum.at(longest_run, rows, segment_lengths)
+    return saturated_samples, longest_run
+
+
+def saturation_batch(signals, sampling_rate, th, chunk_size=16):
+    """
+    -----
+    Brief
+    -----
+    Batched saturation: the duration for which each channel remains at its maximum amplitude, for a whole
+    (n_channels, n_samples) block. Channels are detrended in place in blocks of chunk_size, and the runs of all
+    the channels of a block are encoded at once (saturation_runs). Channels that cannot be scored get NaN
+    instead of stopping the whole call.
+    ----------
+    Parameters
+    ----------
+    signals : nd-array
+        1D signal or (n_channels, n_samples) signals.
+    sampling_rate : int
+        The sampling rate of the signal in Hz.
+    th : float
+        The threshold to consider the maximum amplitude possible.
+    chunk_size : int
+        Number of channels processed at once, bounding the scratch memory to about 11 bytes per sample of a
+        block. Default: 16.
+
+    Returns:
+    -------
+    total_saturation_duration : 1D-array
+        Duration of saturated signal in seconds per channel, counting runs of at least 200 ms as saturation.
+        NaN for channels with NaN or inf values.
+    longest_saturation : 1D-array
+        Duration of the longest run at the maximum amplitude in seconds per channel. NaN for channels with NaN
+        or inf values.
+    """
+    signals = np.atleast_2d(np.asarray(signals))
+    n_channels, n_samples = signals.shape
+    total_saturation_duration = np.full(n_channels, np.nan)
+    longest_saturation = np.full(n_channels, np.nan)
+    if n_samples == 0:
+        return total_saturation_duration, longest_saturation
+
+    scratch = np.empty((min(chunk_size, n_channels), n_samples), dtype=np.float64)
+    for start in range(0, n_channels, chunk_size):
+        block = scratch[:len(signals[start:start + chunk_size])]
+        np.copyto(block, signals[start:start + chunk_size])
+        # Non-finite channels cannot be detrended: they are zeroed and left as NaN
+        valid = np.isfinite(np.sum(block, axis=-1))
+        block[~valid] = 0
+        detrend(block, overwrite_data=True)
+        total, longest = _detrended_saturation(block, np.max(block, axis=-1), sampling_rate, th)
+        total_saturation_duration[start:start + chunk_size][valid] = total[valid]
+        longest_saturation[start:start + chunk_size][valid] = longest[valid]
+    return total_saturation_duration, longest_saturation
+
+
 ##### Powerline Interference ######
 def power_line_noise(data, sampling_rate):
     """
@@ -350,18 +863,93 @@ def power_line_noise(data, sampling_rate):
     Returns:
     -------
     amplitude_50hz : float
-                   The Power amplitude of the 50 Hz frequency contained in the signal.
+                   The Power amplitude of the 50 Hz frequency contained in the signal. NaN when 50 Hz is above the
+                   Nyquist frequency (sampling rates below 100 Hz).
     """
+    # Only the FFT bin nearest to 50 Hz is computed
+    amplitudes, _ = power_line_harmonics(data, sampling_rate, line_freq=50, n_harmonics=1)
+    if amplitudes.shape[-1] == 0:
+        amplitude_50hz = np.full(amplitudes.shape[:-1], np.nan)
+    else:
+        amplitude_50hz = amplitudes[..., 0]
 
-    # Compute the FFT
-    n = len(data)
-    fft_values = fft(data)
-    fft_freq = fftfreq(n, 1 / sampling_rate)
+    return amplitude_50hz if amplitude_50hz.ndim else float(amplitude_50hz)
 
-    # Find the nearest index to 50 Hz in the frequency array
-    idx_50hz = np.argmin(np.abs(fft_freq - 50))
 
-    # Get the amplitude at 50 Hz
-    amplitude_50hz = np.abs(fft_values[idx_50hz])
+def dft_bins(data, bins, chunk_size=2 ** 16):
+    """
+    -----
+    Brief
+    -----
+    Computes the magnitude of a few DFT bins (the same values as np.abs(fft(data))[bins]) in O(n) per bin,
+    like the Goertzel algorithm, without allocating the n-length complex spectrum. The signal is processed in
+    chunks, so the extra memory is bounded by chunk_size samples per bin.
+    ----------
+    Parameters
+    ----------
+    data : nd-array or list
+        1D signal or (n_channels, n_samples) signals.
+    bins : list
+        Indices of the DFT bins to compute.
+    chunk_size : int
+        Number of samples processed at once. Default: 65536.
 
-    return amplitude_50hz
+    Returns:
+    -------
+    magnitudes : nd-array
+        |X[k]| for each bin, shape data.shape[:-1] + (len(bins),).
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[-1]
+    bins = np.asarray(bins, dtype=np.int64)
+    chunk_size = min(chunk_size, n)
+
+    # Twiddle factors of one chunk, computed once; each chunk is then rotated by the phase of its first sample.
+    # Exact integer phases (k * t mod n) keep them accurate on long recordings.
+    phase = (2 * np.pi / n) * (np.outer(np.arange(chunk_size, dtype=np.int64), bins) % n)
+    cos_twiddle = np.cos(phase)
+    sin_twiddle = np.sin(phase)
+
+    spectrum = np.zeros(data.shape[:-1] + (len(bins),), dtype=np.complex128)
+    for start in range(0, n, chunk_size):
+        chunk = data[..., start:start + chunk_size]
+        length = chunk.shape[-1]
+        # Real products only, the signal is never cast to complex
+        chunk_spectrum = chunk @ cos_twiddle[:length] - 1j * (chunk @ sin_twiddle[:length])
+        spectrum += chunk_spectrum * np.exp(-1j * (2 * np.pi / n) * ((bins * start) % n))
+    return np.abs(spectrum)
+
+
+def power_line_harmonics(data, sampling_rate, line_freq=50, n_harmonics=1):
+    """
+    -----
+    Brief
+    -----
+    Computes the powerline noise amplitude at the line frequency (50 or 60 Hz) and its harmonics, reading only
+    the DFT bin nearest to each frequency (dft_bins). Works on a single signal or on a batch of channels.
+    ----------
+    Parameters
+    ----------
+    data : nd-array or list
+        1D signal or (n_channels, n_samples) signals.
+    sampling_rate : int
+        The sampling rate of the signal in Hz.
+    line_freq : float
+        Powerline frequency, 50 (Europe) or 60 (Americas) Hz. Default: 50.
+    n_harmonics : int
+        Number of frequencies analysed: the line frequency and its first n_harmonics - 1 harmonics.
+        Harmonics above the Nyquist frequency are left out. Default: 1.
+
+    Returns:
+    -------
+    amplitudes : nd-array
+        Amplitude at each analysed frequency, shape data.shape[:-1] + (n_frequencies,).
+    frequencies : 1D-array
+        Frequency of the DFT bin used for each harmonic.
+    """
+    n = np.shape(data)[-1]
+    harmonics = line_freq * np.arange(1, n_harmonics + 1)
+    harmonics = harmonics[harmonics <= sampling_rate / 2]
+    # Nearest non-negative frequency bin (ties go to the lower bin, as np.argmin does)
+    bins = np.clip(np.ceil(harmonics * n / sampling_rate - 0.5), 0, n // 2).astype(np.int64)
+    return dft_bins(data, bins), bins * sampling_rate / n
@@ -1,7 +1,14 @@
 import mne
 import os
+import time
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 import pandas as pd
 import numpy as np
+import h5py
 import matplotlib.pyplot as plt
 from scipy.signal import welch
 
@@ -10,113 +17,795 @@ import re
 
 #path = '/Users/Asus/AISYM4MED_1/UMC_data/UMC_data'
 
+# numpy types of the BrainVision binary formats
+BINARY_FORMATS = {'INT_16': '<i2', 'UINT_16': '<u2', 'INT_32': '<i4', 'IEEE_FLOAT_32': '<f4'}
+# Scaling of the BrainVision channel units to Volts (an empty unit means uV)
+UNIT_SCALES = {'': 1e-6, 'µV': 1e-6, 'μV': 1e-6, 'uV': 1e-6, 'mV': 1e-3, 'V': 1.0, 'nV': 1e-9}
+
+
+def _read_vhdr_sections(vhdr_file):
+    # Splits a BrainVision header into its [sections], as {section: {key: value}}
+    with open(vhdr_file, 'rb') as f:
+        raw_text = f.read()
+    try:
+        text = raw_text.decode('utf-8')
+    except UnicodeDecodeError:
+        text = raw_text.decode('latin-1')
+
+    sections = {}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith(';'):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section = sections.setdefault(line[1:-1], {})
+        elif section is not None and '=' in line:
+            key, value = line.split('=', 1)
+            section[key.strip()] = value.strip()
+    return sections
+
+
+def read_vhdr_header(vhdr_file):
+    """
+    -----
+    Brief
+    -----
+    Parses a BrainVision .vhdr header without touching the samples in the .eeg data file.
+    ----------
+    Parameters
+    ----------
+    vhdr_file : string
+        Path to the BrainVision header.
+
+    Returns
+    -------
+    header : dict
+        data_file (path to the .eeg file), orientation ('MULTIPLEXED' or 'VECTORIZED'), dtype, sfreq, ch_names,
+        scales (factor converting each channel to Volts), n_channels and n_samples.
+    """
+    sections = _read_vhdr_sections(vhdr_file)
+    common = sections['Common Infos']
+    if common.get('DataFormat', 'BINARY').upper() != 'BINARY':
+        raise ValueError(f"Only BINARY BrainVision data can be memory-mapped: {vhdr_file}")
+    binary_format = sections.get('Binary Infos', {}).get('BinaryFormat', 'INT_16').upper()
+    if binary_format not in BINARY_FORMATS:
+        raise ValueError(f"Unsupported BrainVision binary format {binary_format}: {vhdr_file}")
+    dtype = np.dtype(BINARY_FORMATS[binary_format])
+
+    n_channels = int(common['NumberOfChannels'])
+    ch_names = []
+    scales = []
+    channel_infos = sections.get('Channel Infos', {})
+    for i in range(n_channels):
+        # Ch<i>=<name>,<reference>,<resolution>,<unit>
+        fields = channel_infos[f'Ch{i + 1}'].split(',')
+        ch_names.append(fields[0].replace(r'\1', ','))
+        resolution = float(fields[2]) if len(fields) > 2 and fields[2] else 1.0
+        unit = fields[3].strip() if len(fields) > 3 else ''
+        scales.append(resolution * UNIT_SCALES.get(unit, 1e-6))
+
+    data_file = os.path.join(os.path.dirname(vhdr_file), common['DataFile'])
+    n_samples = os.path.getsize(data_file) // (dtype.itemsize * n_channels)
+
+    return {'data_file': data_file,
+            'orientation': common.get('DataOrientation', 'MULTIPLEXED').upper(),
+            'dtype': dtype,
+            'sfreq': 1e6 / float(common['SamplingInterval']),
+            'ch_names': ch_names,
+            'scales': np.array(scales),
+            'n_channels': n_channels,
+            'n_samples': n_samples}
+
+
+class ChannelHandle:
+    """
+    -----
+    Brief
+    -----
+    Lazy handle to one channel of a BrainVision recording, backed by a memory map of the .eeg data file.
+    Samples are only read (and scaled to Volts) when the handle is converted with np.asarray or sliced, so a handle
+    costs no memory until a metric touches it. It converts to a (1, n_samples) array, like Raw.get_data(picks=idx).
+    ----------
+    Parameters
+    ----------
+    data_file : string
+        Path to the .eeg data file.
+    dtype : numpy.dtype
+        Type of the stored samples.
+    orientation : string
+        'MULTIPLEXED' or 'VECTORIZED'.
+    n_channels : int
+        Number of channels stored in the data file.
+    n_samples : int
+        Number of samples per channel.
+    index : int
+        Index of the channel in the data file.
+    scale : float
+        Factor converting the stored values to Volts.
+    name : string
+        Channel name.
+    """
+    __slots__ = ('data_file', 'dtype', 'orientation', 'n_channels', 'n_samples', 'index', 'scale', 'name', '_map')
+
+    def __init__(self, data_file, dtype, orientation, n_channels, n_samples, index, scale, name):
+        self.data_file = data_file
+        self.dtype = np.dtype(dtype)
+        self.orientation = orientation
+        self.n_channels = n_channels
+        self.n_samples = n_samples
+        self.index = index
+        self.scale = scale
+        self.name = name
+        self._map = None
+
+    def __reduce__(self):
+        # Pickling ships the location of the channel, never its samples
+        return ChannelHandle, (self.data_file, self.dtype, self.orientation, self.n_channels, self.n_samples,
+                               self.index, self.scale, self.name)
+
+    def __repr__(self):
+        return f'<ChannelHandle {self.name} | {self.n_samples} samples | {os.path.basename(self.data_file)}>'
+
+    @property
+    def shape(self):
+        return 1, self.n_samples
+
+    @property
+    def ndim(self):
+        return 2
+
+    def view(self):
+        """(1, n_samples) view of the stored (unscaled) samples, no data is read."""
+        if self._map is None:
+            if self.orientation == 'VECTORIZED':
+                shape = (self.n_channels, self.n_samples)
+            else:
+                shape = (self.n_samples, self.n_channels)
+            self._map = np.memmap(self.data_file, dtype=self.dtype, mode='r', shape=shape)
+        if self.orientation == 'VECTORIZED':
+            return self._map[self.index:self.index + 1, :]
+        return self._map[:, self.index:self.index + 1].T
+
+    def __getitem__(self, item):
+        # Only the requested samples are read from disk
+        return np.asarray(self.view()[item], dtype=np.float64) * self.scale
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.multiply(self.view(), self.scale, dtype=np.float64)
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+
+
+class ChannelRecord:
+    """
+    -----
+    Brief
+    -----
+    Compact record of one channel: the array (or ChannelHandle) together with its subject, session, condition and
+    channel name. Unpacking a record gives (subject, session, condition, channel, samples), samples being 1D.
+    ----------
+    Parameters
+    ----------
+    subject : string
+        Subject id, e.g. 'sub-01'.
+    session : string
+        Session id, e.g. 'ses-SITUATION1A'.
+    condition : string
+        'healthy' or 'injured'.
+    channel : string
+        Channel name.
+    data : nd-array or ChannelHandle
+        (1, n_times) channel, as stored in the structure_data dictionary.
+    """
+    __slots__ = ('subject', 'session', 'condition', 'channel', 'data')
+
+    def __init__(self, subject, session, condition, channel, data):
+        self.subject = subject
+        self.session = session
+        self.condition = condition
+        self.channel = channel
+        self.data = data
+
+    @property
+    def samples(self):
+        """1D samples of the channel, a lazy channel is read here."""
+        return self.data[0]
+
+    def __iter__(self):
+        return iter((self.subject, self.session, self.condition, self.channel, self.samples))
+
+    def __repr__(self):
+        return f'<ChannelRecord {self.subject} {self.session} {self.condition} {self.channel}>'
+
+
+def group_records(records, *fields):
+    """
+    -----
+    Brief
+    -----
+    Groups channel records by the values of the given fields, keeping the order in which the groups appear.
+    ----------
+    Parameters
+    ----------
+    records : iterable
+        ChannelRecords.
+    *fields : string
+        Record fields to group by, e.g. 'condition', 'subject'.
+
+    Returns
+    -------
+    groups : dict
+        {field value (or tuple of values for several fields): list of ChannelRecords}.
+    """
+    groups = {}
+    for record in records:
+        key = tuple(getattr(record, field) for field in fields)
+        groups.setdefault(key if len(fields) > 1 else key[0], []).append(record)
+    return groups
+
+
+def find_sessions(path):
+    """
+    -----
+    Brief
+    -----
+    Walks the BIDS tree and yields every sub-*/ses-* BrainVision recording found.
+    ----------
+    Parameters
+    ----------
+    path : string
+        Root directory of the dataset.
+
+    Returns
+    -------
+    sessions : generator
+        Tuples of (patient_id, situation_id, vhdr_file).
+    """
+    for foldername, subfolders, filenames in os.walk(path):
+        for filename in filenames:
+            # Check if the file is an EEG file (you may want to add more conditions)
+            if filename.endswith('_ieeg.vhdr'):
+                # Extract patient and situation information from the file path
+                patient_id = None
+                situation_id = None
+                for part in foldername.split(os.sep):
+                    if part.startswith('sub-'):
+                        patient_id = part
+                    elif part.startswith('ses-'):
+                        situation_id = part
+
+                # Check if patient and situation information is found
+                if patient_id and situation_id:
+                    yield patient_id, situation_id, os.path.join(foldername, filename)
+
+
+def session_channels(vhdr_file):
+    """
+    -----
+    Brief
+    -----
+    Reads the channels.tsv and electrodes.tsv sidecars of a session once and returns the included channels that
+    are healthy (not resected) and injured (resected), leaving out the edge contacts.
+    ----------
+    Parameters
+    ----------
+    vhdr_file : string
+        Path to the BrainVision header of the session.
+
+    Returns
+    -------
+    healthy_channels : set
+        Names of the included, not resected, non-edge channels.
+    injured_channels : set
+        Names of the included, resected, non-edge channels.
+    """
+    filename_channel_quality = vhdr_file.replace('acute_ieeg.vhdr', 'acute_channels.tsv')
+    filename_channel_resect = vhdr_file.replace('task-acute_ieeg.vhdr', 'electrodes.tsv')
+
+    # Read the channels.tsv file and keep the channels flagged as included
+    channels_info = pd.read_csv(filename_channel_quality, delimiter='\t')
+    good_channels = set(channels_info.loc[channels_info['status_description'] == 'included', 'name'])
+
+    # Read the electrodes.tsv file once for both channel sets
+    electrodes_info = pd.read_csv(filename_channel_resect, delimiter='\t')
+    not_edge = electrodes_info['edge'] == 'no'
+    injured_channels = set(electrodes_info.loc[(electrodes_info['resected'] == 'yes') & not_edge, 'name'])
+    healthy_channels = set(electrodes_info.loc[(electrodes_info['resected'] == 'no') & not_edge, 'name'])
+
+    return good_channels & healthy_channels, good_channels & injured_channels
+
+
+def build_manifest(path, manifest_file=None):
+    """
+    -----
+    Brief
+    -----
+    Indexes the dataset without decoding any signal: only the .vhdr headers, channels.tsv and electrodes.tsv
+    files are read. The manifest has one row per recorded channel, with where its samples are in the .eeg file,
+    so cohorts can be counted and loads planned ahead.
+    e.g. injured = manifest[(manifest['status'] == 'included') & (manifest['resected'] == 'yes')
+                            & (manifest['edge'] == 'no')]
+    ----------
+    Parameters
+    ----------
+    path : string
+        Root directory of the dataset.
+    manifest_file : string or None
+        If given, the manifest is also written to this tab-separated file. Default: None.
+
+    Returns
+    -------
+    manifest : pandas.DataFrame
+        Columns subject, session, channel, status, resected, edge, n_samples, sfreq, data_file and file_offset
+        (byte offset of the channel's first sample in data_file).
+    """
+    columns = ['subject', 'session', 'channel', 'status', 'resected', 'edge', 'n_samples', 'sfreq', 'data_file',
+               'file_offset']
+    tables = []
+    for patient_id, situation_id, vhdr_file in sorted(find_sessions(path)):
+        header = read_vhdr_header(vhdr_file)
+        itemsize = header['dtype'].itemsize
+        channel_idx = np.arange(header['n_channels'])
+        if header['orientation'] == 'VECTORIZED':
+            file_offset = channel_idx * header['n_samples'] * itemsize
+        else:
+            file_offset = channel_idx * itemsize
+        table = pd.DataFrame({'subject': patient_id, 'session': situation_id, 'channel': header['ch_names'],
+                              'n_samples': header['n_samples'], 'sfreq': header['sfreq'],
+                              'data_file': header['data_file'], 'file_offset': file_offset})
+
+        channels_info = pd.read_csv(vhdr_file.replace('acute_ieeg.vhdr', 'acute_channels.tsv'), delimiter='\t')
+        electrodes_info = pd.read_csv(vhdr_file.replace('task-acute_ieeg.vhdr', 'electrodes.tsv'), delimiter='\t')
+        table = table.merge(channels_info[['name', 'status_description']].rename(
+            columns={'name': 'channel', 'status_description': 'status'}), on='channel', how='left')
+        table = table.merge(electrodes_info[['name', 'resected', 'edge']].rename(columns={'name': 'channel'}),
+                            on='channel', how='left')
+        tables.append(table[columns])
+
+    manifest = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=columns)
+    if manifest_file is not None:
+        manifest.to_csv(manifest_file, sep='\t', index=False)
+    return manifest
+
+
+def load_session(vhdr_file, lazy=False):
+    """
+    -----
+    Brief
+    -----
+    Single-pass session loader. The sidecar tables are read once, the BrainVision recording is decoded once and
+    the healthy and injured channel sets are split from that single in-memory array.
+    In lazy mode only the header is parsed and the channels are returned as memory-mapped ChannelHandles.
+    ----------
+    Parameters
+    ----------
+    vhdr_file : string
+        Path to the BrainVision header of the session.
+    lazy : bool
+        If True, return ChannelHandles instead of preloaded Raw objects. Default: False.
+
+    Returns
+    -------
+    session : dict
+        {'healthy': Raw or None, 'injured': Raw or None}, None when the session has no channel of that condition.
+        In lazy mode the Raw objects are replaced by lists of ChannelHandles.
+    """
+    healthy_channels, injured_channels = session_channels(vhdr_file)
+    session = {'healthy': None, 'injured': None}
+    if not healthy_channels and not injured_channels:
+        return session
+
+    if lazy:
+        header = read_vhdr_header(vhdr_file)
+        for condition, channels in (('healthy', healthy_channels), ('injured', injured_channels)):
+            handles = [ChannelHandle(header['data_file'], header['dtype'], header['orientation'],
+                                     header['n_channels'], header['n_samples'], idx, header['scales'][idx], name)
+                       for idx, name in enumerate(header['ch_names']) if name in channels]
+            if handles:
+                session[condition] = handles
+        return session
+
+    raw = mne.io.read_raw_brainvision(vhdr_file, preload=True)
+    # Channels keep the order in which they were recorded
+    healthy = [ch for ch in raw.ch_names if ch in healthy_channels]
+    injured = [ch for ch in raw.ch_names if ch in injured_channels]
+
+    # Dropping the unused channels first, so only the kept ones are copied
+    raw.pick(healthy + injured)
+    if injured:
+        session['injured'] = raw.copy().pick(injured) if healthy else raw
+    if healthy:
+        session['healthy'] = raw.pick(healthy)
+    return session
+
+
+def session_signature(vhdr_file):
+    """
+    -----
+    Brief
+    -----
+    Signature of the files a session is built from: the modification time and size of the .vhdr, the data file it
+    points to (DataFile), channels.tsv and electrodes.tsv. A cached session is valid as long as its signature is
+    unchanged.
+    ----------
+    Parameters
+    ----------
+    vhdr_file : string
+        Path to the BrainVision header of the session.
+
+    Returns
+    -------
+    signature : string
+        JSON list of [file name, mtime in ns, size in bytes].
+    """
+    data_file = _read_vhdr_sections(vhdr_file)['Common Infos']['DataFile']
+    files = [vhdr_file,
+             os.path.join(os.path.dirname(vhdr_file), data_file),
+             vhdr_file.replace('acute_ieeg.vhdr', 'acute_channels.tsv'),
+             vhdr_file.replace('task-acute_ieeg.vhdr', 'electrodes.tsv')]
+    signature = []
+    for filename in files:
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            signature.append([os.path.basename(filename), stat.st_mtime_ns, stat.st_size])
+    return json.dumps(signature)
+
+
+def _read_cached_session(group):
+    # Session stored by _write_cached_session: {condition: (ch_names, (n_channels, n_times) array) or None}
+    session = {'healthy': None, 'injured': None}
+    for condition in session:
+        if condition in group:
+            ch_names = [name.decode() if isinstance(name, bytes) else name for name in group[condition]['ch_names']]
+            session[condition] = (ch_names, group[condition]['data'][()])
+    return session
+
+
+def _compact_cache(cache_path, keys):
+    # HDF5 does not give back the space of deleted groups, so outdated sessions are dropped by copying the other
+    # ones to a new file, which then replaces the cache
+    compacted_path = cache_path + '.tmp'
+    with h5py.File(cache_path, 'r') as cache, h5py.File(compacted_path, 'w') as compacted:
+        for key in keys:
+            cache.copy(cache[key], compacted, name=key)
+    os.replace(compacted_path, cache_path)
+
+
+def _write_cached_session(cache, key, signature, session):
+    # One group per session, one chunk per channel so that single channels can be read back on their own.
+    # The signature is written last: a group left without one by an interrupted run is outdated (load_sessions).
+    group = cache.create_group(key)
+    for condition, recording in session.items():
+        if recording is None:
+            continue
+        ch_names, data = recording
+        condition_group = group.create_group(condition)
+        condition_group.create_dataset('ch_names', data=np.array(ch_names, dtype=h5py.string_dtype()))
+        condition_group.create_dataset('data', data=data, chunks=(1, min(data.shape[1], 2 ** 20)))
+    cache.flush()
+    group.attrs['signature'] = signature
+
+
+def _timed_load_session(vhdr_file, lazy=False):
+    # Worker of load_sessions: loads one session as {condition: (ch_names, data)} and measures how long it took.
+    # data is a (n_channels, n_times) array, or a list of ChannelHandles in lazy mode.
+    start = time.perf_counter()
+    session = load_session(vhdr_file, lazy=lazy)
+    for condition, recording in session.items():
+        if recording is None:
+            continue
+        if lazy:
+            session[condition] = ([handle.name for handle in recording], recording)
+        else:
+            session[condition] = (recording.ch_names, recording.get_data())
+    return session, time.perf_counter() - start
+
+
+def _bounded_map(executor, func, items, window):
+    # executor.map submits every item at once, so finished sessions would pile up in memory while the caller is
+    # still consuming the first ones. Here at most window items are in flight, and results come in submission order.
+    items = iter(items)
+    pending = deque(executor.submit(func, item) for item in islice(items, window))
+    while pending:
+        future = pending.popleft()
+        for item in islice(items, 1):
+            pending.append(executor.submit(func, item))
+        yield future.result()
+
+
+def _check_n_jobs(n_jobs):
+    # 0 and negative numbers other than -1 would only fail later, in ProcessPoolExecutor
+    if not isinstance(n_jobs, (int, np.integer)) or isinstance(n_jobs, bool) or not (n_jobs == -1 or n_jobs >= 1):
+        raise ValueError(f"n_jobs must be -1 or a positive integer, got {n_jobs!r}.")
+
+
+def load_sessions(path, lazy=False, n_jobs=1, cache_path=None):
+    """
+    -----
+    Brief
+    -----
+    Loads every session of the dataset with load_session, optionally fanning the decoding out to a process pool.
+    Sessions are yielded in sorted (patient, situation) order, whatever the order in which the workers finish,
+    and the time taken by each session is printed. At most n_jobs sessions are decoded ahead of the one being
+    consumed, so the decoded sessions do not pile up in memory.
+    With a cache_path, decoded sessions are stored in a single HDF5 file and read back from it as long as their
+    files keep the same modification time and size (session_signature), so only new or changed sessions are
+    decoded. The outdated sessions are dropped by rewriting the cache without them, as HDF5 files do not shrink.
+    With n_jobs != 1 on platforms that spawn processes (Windows, macOS), the calling script needs an
+    if __name__ == '__main__' guard.
+    ----------
+    Parameters
+    ----------
+    path : string
+        Root directory of the dataset.
+    lazy : bool
+        If True, sessions hold ChannelHandles instead of decoded arrays. The cache is not used. Default: False.
+    n_jobs : int
+        Number of worker processes. 1 loads the sessions serially, -1 uses all the cores. Any other value raises
+        a ValueError. Default: 1.
+    cache_path : string or None
+        Path of the HDF5 cache file, created if missing. Ignored in lazy mode. Default: None (no cache).
+
+    Returns
+    -------
+    sessions : generator
+        Tuples of (patient_id, situation_id, session, elapsed). session is a dict
+        {'healthy': (ch_names, channels) or None, 'injured': (ch_names, channels) or None}, channels being a list of
+        (1, n_times) row views of the session array or of ChannelHandles. elapsed is the loading time in seconds.
+    """
+    _check_n_jobs(n_jobs)
+    sessions = sorted(find_sessions(path))
+    cache = None
+    signatures = {}
+    if cache_path is not None and not lazy:
+        signatures = {f'{patient_id}_{situation_id}': session_signature(vhdr_file)
+                      for patient_id, situation_id, vhdr_file in sessions}
+        if os.path.exists(cache_path):
+            with h5py.File(cache_path, 'r') as cache:
+                cached = set(cache)
+                # Groups without a signature were not written completely
+                outdated = {key for key in cached if 'signature' not in cache[key].attrs
+                            or key in signatures and cache[key].attrs['signature'] != signatures[key]}
+            if outdated:
+                _compact_cache(cache_path, sorted(cached - outdated))
+        cache = h5py.File(cache_path, 'a')
+    executor = None
+    try:
+        # Only the sessions missing from the cache, or whose files changed, are decoded
+        stale = [vhdr_file for patient_id, situation_id, vhdr_file in sessions
+                 if cache is None or f'{patient_id}_{situation_id}' not in cache]
+
+        loader = partial(_timed_load_session, lazy=lazy)
+        if n_jobs == 1 or len(stale) < 2:
+            results = map(loader, stale)
+        else:
+            n_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+            results = _bounded_map(executor, loader, stale, n_workers)
+
+        stale = set(stale)
+        for patient_id, situation_id, vhdr_file in sessions:
+            key = f'{patient_id}_{situation_id}'
+            if vhdr_file in stale:
+                session, elapsed = next(results)
+                source = 'decoded'
+                if cache is not None:
+                    _write_cached_session(cache, key, signatures[key], session)
+            else:
+                start = time.perf_counter()
+                session = _read_cached_session(cache[key])
+                elapsed = time.perf_counter() - start
+                source = 'cached'
+            print(f'{key} loaded in {elapsed:.2f} s ({source})')
+
+            for condition, recording in session.items():
+                if recording is not None and not lazy:
+                    # The channels are row views of the single session array
+                    ch_names, data = recording
+                    session[condition] = (ch_names, extract_channels(data))
+            yield patient_id, situation_id, session, elapsed
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if cache is not None:
+            cache.close()
+
+
+def iter_channels(path, lazy=False, n_jobs=1, cache_path=None):
+    """
+    -----
+    Brief
+    -----
+    Streaming counterpart of structure_data: yields the channels of the dataset one at a time instead of building
+    the whole dictionary, so metrics can run on cohorts bigger than the memory.
+    Eager mode holds one session in memory at a time; lazy mode only reads each channel when it is yielded.
+    e.g. for patient_id, session_id, condition, channel_name, samples in iter_channels(path, lazy=True):
+             values[patient_id, session_id, channel_name] = completeness(samples)
+    ----------
+    Parameters
+    ----------
+    path : string
+        Root directory of the dataset.
+    lazy : bool
+        If True, channels are read from memory-mapped .eeg files when they are reached. Default: False.
+    n_jobs : int
+        Number of worker processes decoding the sessions, see load_sessions. Default: 1.
+    cache_path : string or None
+        Path of the HDF5 session cache, see load_sessions. Default: None (no cache).
+
+    Returns
+    -------
+    channels : generator
+        ChannelRecords, which unpack into (patient_id, session_id, condition, channel_name, samples), samples being
+        a 1D array in Volts.
+    """
+    for patient_id, session_id, session, _ in load_sessions(path, lazy=lazy, n_jobs=n_jobs, cache_path=cache_path):
+        for condition, recording in session.items():
+            if recording is None:
+                continue
+            for channel_name, channel in zip(*recording):
+                yield ChannelRecord(patient_id, session_id, condition, channel_name, channel)
+
+
+def segment_signal(samples, segment_len=2048, overlap=0, edge='drop', nan_policy='keep'):
+    """
+    -----
+    Brief
+    -----
+    Cuts a 1D signal into fixed-length segments, optionally overlapping. The segments are a strided view of the
+    signal, no data is copied unless edge='pad', or nan_policy='drop' with segments containing NaN.
+    ----------
+    Parameters
+    ----------
+    samples : 1D-array
+        The input signal.
+    segment_len : int
+        Number of samples per segment. Default: 2048.
+    overlap : int
+        Number of samples shared by consecutive segments, 0 <= overlap < segment_len. Default: 0.
+    edge : string
+        What to do with the trailing samples that do not fill a segment: 'drop' them, or 'pad' the last segment
+        with NaN (copies the signal). Default: 'drop'.
+    nan_policy : string
+        'keep' segments containing NaN, 'drop' them (copies the remaining segments) or 'raise' a ValueError.
+        Default: 'keep'.
+
+    Returns
+    -------
+    segments : nd-array
+        (n_segments, segment_len) array.
+    """
+    samples = np.asarray(samples)
+    if samples.ndim != 1:
+        raise ValueError(f"Expected a 1D signal, got shape {samples.shape}.")
+    if not 0 <= overlap < segment_len:
+        raise ValueError(f"overlap must be in [0, {segment_len}), got {overlap}.")
+    step = segment_len - overlap
+
+    if edge == 'pad' and len(samples):
+        n_segments = max(int(np.ceil((len(samples) - segment_len) / step)), 0) + 1
+        samples = np.pad(samples.astype(np.float64), (0, (n_segments - 1) * step + segment_len - len(samples)),
+                         constant_values=np.nan)
+    elif edge not in ('drop', 'pad'):
+        raise ValueError(f"edge must be 'drop' or 'pad', got {edge!r}.")
+
+    if len(samples) < segment_len:
+        return samples[:0].reshape(0, segment_len)
+    segments = np.lib.stride_tricks.sliding_window_view(samples, segment_len)[::step]
+
+    if nan_policy != 'keep':
+        has_nan = np.isnan(segments).any(axis=1)
+        if nan_policy == 'raise' and has_nan.any():
+            raise ValueError(f"{int(has_nan.sum())} segments contain NaN values.")
+        elif nan_policy == 'drop' and has_nan.any():
+            segments = segments[~has_nan]
+        elif nan_policy not in ('raise', 'drop'):
+            raise ValueError(f"nan_policy must be 'keep', 'drop' or 'raise', got {nan_policy!r}.")
+    return segments
+
+
+def segment_records(records, segment_len=2048, overlap=0, edge='drop', nan_policy='keep'):
+    """
+    -----
+    Brief
+    -----
+    Segmentation stage on top of iter_channels/structure_data records: yields every channel as a batch of
+    fixed-length segments (see segment_signal), ready for the quality metrics or the generator training.
+    ----------
+    Parameters
+    ----------
+    records : iterable
+        ChannelRecords.
+    segment_len : int
+        Number of samples per segment. Default: 2048.
+    overlap : int
+        Number of samples shared by consecutive segments. Default: 0.
+    edge : string
+        'drop' or 'pad', see segment_signal. Default: 'drop'.
+    nan_policy : string
+        'keep', 'drop' or 'raise', see segment_signal. Default: 'keep'.
+
+    Returns
+    -------
+    segments : generator
+        Tuples of (record, (n_segments, segment_len) array).
+    """
+    for record in records:
+        yield record, segment_signal(record.samples, segment_len, overlap, edge, nan_policy)
+
+
+def extract_channels(raw_object):
+    """
+    -----
+    Brief
+    -----
+    Extracts the channels of a recording with a single get_data call. The channels are zero-copy row views of the
+    one contiguous 2D array holding the whole recording.
+    ----------
+    Parameters
+    ----------
+    raw_object : Raw or nd-array
+        The recording, or its already decoded (n_channels, n_times) array.
+
+    Returns
+    -------
+    channels : list
+        (1, n_times) views, one per channel, in the order of the recorded channels.
+    """
+    data = raw_object.get_data() if isinstance(raw_object, mne.io.BaseRaw) else raw_object
+    return [data[channel_idx:channel_idx + 1] for channel_idx in range(data.shape[0])]
+
 
 def structure_data(path,
-        model_type):  # change this to take arguments of type (classifier, location generator, data generator, etc)
+        model_type, lazy=False, n_jobs=1, cache_path=None, return_records=False):  # change this to take arguments of type (classifier, location generator, data generator, etc)
+    """
+    -----
+    Brief
+    -----
+    Builds the dataset structure needed by a model from the BIDS sessions found under path. The 'classifier',
+    'chan_gen' and 'breakdown' modes load every session once with iter_channels (through load_sessions), the
+    'loc_gen' mode only reads the electrodes.tsv files.
+    ----------
+    Parameters
+    ----------
+    path : string
+        Root directory of the dataset.
+    model_type : string
+        'classifier' or 'chan_gen' for {'healthy': [...], 'injured': [...]} with one list of (1, n_times) channels
+        per subject, 'breakdown' for {condition: {patient_id: {session_id: {channel_name: channel}}}} and
+        'loc_gen' for {i: binary list of the resected channels} per session.
+    lazy : bool
+        If True, channels are ChannelHandles reading the memory-mapped .eeg files when they are used, instead of
+        decoded arrays. The cache is not used. Ignored by 'loc_gen'. Default: False.
+    n_jobs : int
+        Number of worker processes decoding the sessions, see load_sessions. 1 loads them serially, -1 uses all
+        the cores. Ignored by 'loc_gen'. Default: 1.
+    cache_path : string or None
+        Path of the HDF5 session cache, see load_sessions. Ignored by 'loc_gen'. Default: None (no cache).
+    return_records : bool
+        If True, the 'classifier' and 'chan_gen' modes also return the list of ChannelRecords the dictionary was
+        built from. Default: False.
+
+    Returns
+    -------
+    data : dict
+        Dataset structure of the model_type, followed by the ChannelRecords list when return_records is True.
+    """
+    _check_n_jobs(n_jobs)
     # Directory containing your EEG files
     eeg_directory = path
     if model_type == 'classifier' or model_type == 'chan_gen':
         eeg_directory = path
-        # Initialize an empty dictionary to store EEG data
-        eeg_data_dict_injured = {}
-        eeg_data_dict_healthy = {}
-
-        # Iterate through all files in the directory and its subdirectories
-        for foldername, subfolders, filenames in os.walk(eeg_directory):
-            for filename in filenames:
-                # Check if the file is an EEG file (you may want to add more conditions)
-                if filename.endswith('_ieeg.vhdr'):
-                    # Extract patient and situation information from the file path
-                    path_parts = foldername.split(os.sep)
-                    patient_id = None
-                    situation_id = None
-
-                    vhdr_file = os.path.join(foldername, filename)
-                    filename_channel_quality = vhdr_file.replace('acute_ieeg.vhdr', 'acute_channels.tsv')
-                    filename_channel_resect = vhdr_file.replace('task-acute_ieeg.vhdr', 'electrodes.tsv')
-                    for part in path_parts:
-                        if part.startswith('sub-'):
-                            patient_id = part
-                        elif part.startswith('ses-'):
-                            situation_id = part
-
-                    # Check if patient and situation information is found
-                    if patient_id and situation_id:
-                        # Create the dictionary key
-                        key = f'{patient_id}_{situation_id}'
-
-                        file_path = os.path.join(foldername, filename)
-
-                        # Add the EEG information to the dictionary
-                        # eeg_data_dict[key] = {'file_path': file_path}
+        # Iterate through all the sessions in the directory and its subdirectories
+        # Each recording is decoded once (or read from the cache) and split into both channel sets.
+        # In lazy mode the channels are memory-mapped handles, so memory grows with the kept channels only.
+        records = list(iter_channels(eeg_directory, lazy=lazy, n_jobs=n_jobs, cache_path=cache_path))
 
-                        # Read the channels.tsv file
-                        channels_info = pd.read_csv(filename_channel_quality, delimiter='\t')
-                        # Extract good channels based on the "sampling_frequency" column
-                        good_channels = channels_info.loc[
-                            channels_info['status_description'] == 'included', 'name'].tolist()
-
-                        # Read the channels.tsv file
-                        channels_info = pd.read_csv(filename_channel_resect, delimiter='\t')
-                        # Extract good channels based on the "sampling_frequency" column
-                        injured_channels = channels_info.loc[
-                            (channels_info['resected'] == 'yes') & (channels_info['edge'] == 'no'), 'name'].tolist()
-
-                        common_channels_injured = list(set(good_channels).intersection(injured_channels))
-                        if common_channels_injured != []:
-                            raw = mne.io.read_raw_brainvision(vhdr_file, preload=True)
-                            raw_injured = raw.pick_channels(
-                                ch_names=common_channels_injured)  # good_channels) #apparently pick_channels is a legacy function and should use inst.pick or something
-                            # Store the raw data in the dictionary with the constructed key
-                            eeg_data_dict_injured[key] = raw_injured
-
-                        # Read the channels.tsv file
-                        channels_info = pd.read_csv(filename_channel_resect, delimiter='\t')
-                        # Extract good channels based on the "sampling_frequency" column
-                        healthy_channels = channels_info.loc[
-                            (channels_info['resected'] == 'no') & (channels_info['edge'] == 'no'), 'name'].tolist()
-
-                        common_channels_healthy = list(set(good_channels).intersection(healthy_channels))
-                        if common_channels_healthy != []:
-                            raw = mne.io.read_raw_brainvision(vhdr_file, preload=True)
-                            raw_healthy = raw.pick_channels(ch_names=common_channels_healthy)
-                            eeg_data_dict_healthy[key] = raw_healthy
-
-        # Create a new dictionary to store the combined data
-        combined_dict = {'healthy': list(eeg_data_dict_healthy.values()),
-                         'injured': list(eeg_data_dict_injured.values())}
-        print("combined dict complete")
-
-        # Example function to extract channels from raw data
-        def extract_channels(raw_object):
-            channels = []
-            for channel_idx in range(raw_object.info['nchan']):
-                channel_data = raw_object.get_data(picks=channel_idx)
-                channels.append(channel_data)
-            return channels
-
-        # Create a new dictionary to store the simplified data
+        # Create a new dictionary to store the simplified data, one list of channels per subject
         simplified_dict = {'healthy': [], 'injured': []}
-
-        # Dictionary to keep track of subjects and their indices in simplified_dict
-        subject_indices = {'healthy': {}, 'injured': {}}
-
-        # Iterate through the combined_dict and extract channels
-        for condition, raw_objects in combined_dict.items():
-            for raw_object in raw_objects:
-                # Extract subject information from the raw_object string representation
-                subject_info_start = raw_object.__str__().find('sub-')
-                subject_info_end = raw_object.__str__().find('_ses-')
-                subject_key = raw_object.__str__()[subject_info_start:subject_info_end]
-
-                # Check if the subject already exists in the simplified_dict
-                if subject_key not in subject_indices[condition]:
-                    subject_indices[condition][subject_key] = len(simplified_dict[condition])
-                    simplified_dict[condition].append([])
-
-                # Extract channels and add them to the corresponding subject's entry
-                channels = extract_channels(raw_object)
-                simplified_dict[condition][subject_indices[condition][subject_key]].extend(channels)
+        for (condition, subject), subject_records in group_records(records, 'condition', 'subject').items():
+            simplified_dict[condition].append([record.data for record in subject_records])
 
         """
         #If it is necessary to use a json for something. Note: This is unecessary for the training process
@@ -147,6 +836,8 @@ def structure_data(path,
         print(f"The simplified_dict has been saved to {json_file_path}")
         """
 
+        if return_records:
+            return simplified_dict, records
         return simplified_dict
 
     elif model_type == 'loc_gen':
@@ -195,100 +886,13 @@ def structure_data(path,
         return new_dict  # binary_channel_dict
 
     elif model_type == "breakdown":
-        eeg_directory = r"E:\Code snippets\IntraOp Data"
-        # Initialize an empty dictionary to store EEG data
-        eeg_data_dict_injured = {}
-        eeg_data_dict_healthy = {}
+        # Per-patient/per-session/per-channel tree, built on the same single-pass loader and cache as the
+        # classifier mode. The channels are row views of the session arrays (or handles in lazy mode).
         hitorie = {"healthy": {}, "injured": {}}
-        # Iterate through all files in the directory and its subdirectories
-        for foldername, subfolders, filenames in os.walk(eeg_directory):
-            for filename in filenames:
-                # Check if the file is an EEG file (you may want to add more conditions)
-                if filename.endswith('_ieeg.vhdr'):
-                    # Extract patient and situation information from the file path
-                    path_parts = foldername.split(os.sep)
-                    patient_id = None
-                    situation_id = None
-
-                    vhdr_file = os.path.join(foldername, filename)
-                    filename_channel_quality = vhdr_file.replace('acute_ieeg.vhdr', 'acute_channels.tsv')
-                    filename_channel_resect = vhdr_file.replace('task-acute_ieeg.vhdr', 'electrodes.tsv')
-                    for part in path_parts:
-                        if part.startswith('sub-'):
-                            patient_id = part
-                        elif part.startswith('ses-'):
-                            situation_id = part
-
-                    # Check if patient and situation information is found
-                    if patient_id and situation_id:
-                        # Create the dictionary key
-                        key = f'{patient_id}_{situation_id}'
-
-                        file_path = os.path.join(foldername, filename)
-
-                        # Add the EEG information to the dictionary
-                        # eeg_data_dict[key] = {'file_path': file_path}
-
-                        # Read the channels.tsv file
-                        channels_info = pd.read_csv(filename_channel_quality, delimiter='\t')
-                        # Extract good channels based on the "sampling_frequency" column
-                        good_channels = channels_info.loc[
-                            channels_info['status_description'] == 'included', 'name'].tolist()
-
-                        # Read the channels.tsv file
-                        channels_info = pd.read_csv(filename_channel_resect, delimiter='\t')
-                        # Extract good channels based on the "sampling_frequency" column
-                        injured_channels = channels_info.loc[
-                            (channels_info['resected'] == 'yes') & (channels_info['edge'] == 'no'), 'name'].tolist()
-
-                        common_channels_injured = list(set(good_channels).intersection(injured_channels))
-                        if common_channels_injured != []:
-                            raw = mne.io.read_raw_brainvision(vhdr_file, preload=True)
-                            raw_injured = raw.pick_channels(
-                                ch_names=common_channels_injured)  # good_channels) #apparently pick_channels is a legacy function and should use inst.pick or something
-                            # Store the raw data in the dictionary with the constructed key
-                            eeg_data_dict_injured[key] = raw_injured
-
-                        # Read the channels.tsv file
-                        channels_info = pd.read_csv(filename_channel_resect, delimiter='\t')
-                        # Extract good channels based on the "sampling_frequency" column
-                        healthy_channels = channels_info.loc[
-                            (channels_info['resected'] == 'no') & (channels_info['edge'] == 'no'), 'name'].tolist()
-
-                        common_channels_healthy = list(set(good_channels).intersection(healthy_channels))
-                        if common_channels_healthy != []:
-                            raw = mne.io.read_raw_brainvision(vhdr_file, preload=True)
-                            raw_healthy = raw.pick_channels(ch_names=common_channels_healthy)
-                            eeg_data_dict_healthy[key] = raw_healthy
-
-                        # Example function to extract channels from raw data
-                        def extract_channels(raw_object):
-                            channels_dict = {}
-                            ch_names = raw_object.ch_names  # Get the channel names
-
-                            for channel_idx, ch_name in enumerate(ch_names):
-                                channel_data = raw_object.get_data(picks=channel_idx)
-                                channels_dict[ch_name] = channel_data
-
-                            return channels_dict
-
-                        if patient_id not in hitorie and common_channels_healthy != []:
-                            # If the patient ID doesn't exist, create a new entry
-                            channels = extract_channels(raw_healthy)
-                            hitorie["healthy"][patient_id] = {situation_id: channels}
-                        elif common_channels_healthy != []:
-                            # If the patient ID already exists, add the new situation code and data
-                            channels = extract_channels(raw_healthy)
-                            hitorie["healthy"][patient_id][situation_id] = channels
-
-                        if patient_id not in hitorie and common_channels_injured != []:
-                            # If the patient ID doesn't exist, create a new entry
-                            channels = extract_channels(raw_injured)
-                            hitorie["injured"][patient_id] = {situation_id: channels}
-                        elif common_channels_injured != []:
-                            # If the patient ID already exists, add the new situation code and data
-                            channels = extract_channels(raw_injured)
-                            hitorie["injured"][patient_id][situation_id] = channels
+        for record in iter_channels(eeg_directory, lazy=lazy, n_jobs=n_jobs, cache_path=cache_path):
+            # Sessions of a patient already in the tree are added next to the previous ones
+            patient_sessions = hitorie[record.condition].setdefault(record.subject, {})
+            patient_sessions.setdefault(record.session, {})[record.channel] = record.data
 
         return hitorie
 
@@ -0,0 +1,134 @@
+### Packages ###
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from scipy.signal import welch
+
+
+class SpectralCache:
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        """
+        -----
+        Brief
+        -----
+        Least-recently-used cache of Welch power spectral densities. Entries are keyed on the identity of the
+        signal (a hash of its contents, or a key supplied by the caller) plus the transform parameters, so every
+        spectral metric run on the same signal shares a single computation of the PSD.
+        ----------
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum size of the cached arrays, in bytes. The least recently used entries are evicted first, and
+            results bigger than the whole budget are not cached. 0 disables the cache. Default: 64 MiB.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def signal_key(signal):
+        """
+        -----
+        Brief
+        -----
+        Identifies a signal by its type, shape and a hash of its contents. Hashing reads the whole signal once,
+        which is cheap next to a Welch PSD but can be avoided by passing a key to SpectralCache.welch.
+        ----------
+        Parameters
+        ----------
+        signal : nd-array or list
+            Input signal(s).
+        Returns
+        -------
+        key : tuple
+            (dtype, shape, digest).
+        """
+        signal = np.ascontiguousarray(signal)
+        digest = hashlib.blake2b(signal.view(np.uint8).ravel(), digest_size=16).hexdigest()
+        return signal.dtype.str, signal.shape, digest
+
+    def get(self, key, compute):
+        """
+        -----
+        Brief
+        -----
+        Returns the cached value of key, computing and storing it on a miss.
+        ----------
+        Parameters
+        ----------
+        key : tuple
+            Cache key.
+        compute : function
+            Called without arguments on a miss. Its result must be a tuple of arrays.
+        Returns
+        -------
+        value : tuple
+            Cached arrays. They are shared between the callers, hence read-only.
+        """
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        value = tuple(compute())
+        nbytes = sum(array.nbytes for array in value)
+        for array in value:
+            array.flags.writeable = False
+        if nbytes <= self.max_bytes:
+            self._entries[key] = value
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= sum(array.nbytes for array in evicted)
+        return value
+
+    def welch(self, signal, fs, nperseg, window='hann', key=None):
+        """
+        -----
+        Brief
+        -----
+        Cached scipy.signal.welch along the last axis. The returned arrays are copies of the cached ones, so the
+        callers are free to modify them.
+        ----------
+        Parameters
+        ----------
+        signal : nd-array or list
+            1D signal or (n_channels, n_samples) signals.
+        fs : float
+            Sampling frequency in Hz.
+        nperseg : int
+            Length of each Welch segment.
+        window : string
+            Window applied to each segment. Default: 'hann' (scipy's default).
+        key : hashable
+            Identity of the signal supplied by the caller, e.g. (session, channel), used instead of hashing the
+            signal. Default: None (signal_key).
+        Returns
+        -------
+        f : 1D-array
+            Sampling frequencies.
+        psd : nd-array
+            Power spectral density, along the last axis.
+        """
+        def compute():
+            return welch(signal, fs, window=window, nperseg=nperseg, axis=-1)
+
+        if self.max_bytes <= 0:
+            return compute()
+        key = ('welch', self.signal_key(signal) if key is None else key, fs, nperseg, window)
+        f, psd = self.get(key, compute)
+        return f.copy(), psd.copy()
+
+    def clear(self):
+        """Drops every cached PSD and resets the hit/miss counters."""
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+# Cache shared by QualityMetrics and SyntheticMetrics
+spectral_cache = SpectralCache()
@@ -18,6 +18,7 @@ from scipy.integrate import simps
 ## Diversity Metrics ##
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
+from SpectralCache import spectral_cache
 
 
 # Functions to generate synthetic timeseries
@@ -501,7 +502,7 @@ class FrequencyAnalysis:
 
         for sig in range(n_signals):
             # Compute the Power Spectral Density (PSD) using Welch's method
-            freqs_, psd_ = welch(data[sig], self.fs, nperseg=win)
+            freqs_, psd_ = spectral_cache.welch(data[sig], self.fs, nperseg=win)
             freqs.append(freqs_)
             psd.append(psd_)
             freq_res = freqs[sig][1] - freqs[sig][0]
@@ -0,0 +1,28 @@
+import numpy as np
+import DictFunc
+from DatasetStore import ChannelStore, is_leaf
+
+
+def _ragged():
+    channels = np.empty(2, dtype=object)
+    channels[:] = [np.arange(4.0), np.arange(6.0)]
+    return channels
+
+
+def test_object_arrays_are_containers():
+    assert is_leaf(np.arange(4.0)) and is_leaf([1.0, 2.0]) and is_leaf([])
+    assert not is_leaf(_ragged())
+    assert not is_leaf(np.zeros((2, 4)))
+
+
+def test_ragged_object_array_branch():
+    dataset = {'healthy': _ragged()}
+    assert DictFunc.apply_function_to_timeseries(dataset, len) == {'healthy': [4, 6]}
+    store = ChannelStore.from_nested(dataset)
+    assert store.to_nested(store.lengths) == {'healthy': [4, 6]}
+
+
+def test_batched_map_concatenates_block_arrays():
+    store = ChannelStore.from_nested({'a': [np.arange(4.0), np.arange(6.0), np.ones(4)]})
+    lengths = store.map(lambda block: np.full(len(block), block.shape[1]), batched=True)
+    assert store.to_nested(lengths) == {'a': [4, 6, 4]}
@@ -0,0 +1,125 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import DictFunc
+from SignalDictBuilder import ChannelHandle
+
+METRICS = {'QCOD': 4, 'Completeness': 95, 'Uniqueness': 95, 'Hurst': 0.9, 'Amplitude': 3, 'PCA': 2, 'SNR': 2,
+           'Saturation': 3, 'Powerline': 3}
+CLASSIFIERS = {'QCOD': lambda x, fs, signal_type: DictFunc.noise_classify(x, fs, signal_type),
+               'Completeness': lambda x, fs, signal_type: DictFunc.completeness_classify(x),
+               'Uniqueness': lambda x, fs, signal_type: DictFunc.uniqueness_classify(x),
+               'Hurst': lambda x, fs, signal_type: DictFunc.hurst_classify(x),
+               'Amplitude': lambda x, fs, signal_type: DictFunc.classify_amplitude(x, signal_type),
+               'PCA': DictFunc.pca_classify,
+               'SNR': lambda x, fs, signal_type: DictFunc.snr_classify(x),
+               'Saturation': DictFunc.saturation_classify,
+               'Powerline': DictFunc.power_line_classify}
+
+
+def _dataset(n_samples=1024 * 4):
+    rng = np.random.default_rng(0)
+    # Channels of two lengths and amplitudes spanning several quality levels, as (1, n_samples) arrays
+    return {'healthy': [[rng.standard_normal((1, n_samples)) * scale for scale in (1e-5, 1e-3, 50)]
+                        for _ in range(2)],
+            'injured': [[rng.standard_normal((1, n_samples // 2)) * 1e-5,
+                         np.cumsum(rng.standard_normal((1, n_samples)), axis=-1)]]}
+
+
+# Classifiers that accept channels with missing (NaN) samples, the others raise on them
+NAN_CLASSIFIERS = ('PCA', 'SNR', 'Saturation')
+
+
+@pytest.mark.parametrize('signal_type', ['EEG', 'ECG'])
+def test_evaluate_quality_matches_the_classifiers(signal_type):
+    dataset = _dataset()
+    gap = np.random.default_rng(1).standard_normal((1, 4096)) * 1e-5
+    gap[0, :512] = np.nan
+    results, mask = DictFunc.evaluate_quality(dict(dataset, gaps=[gap]), METRICS, fs=1024, signal_type=signal_type)
+    masks = []
+    for name, classify in CLASSIFIERS.items():
+        expected = DictFunc.apply_function_to_timeseries(dataset, classify, 1024, signal_type)
+        np.testing.assert_allclose(DictFunc.nested_to_array({key: results[name][key] for key in dataset}),
+                                   DictFunc.nested_to_array(expected), rtol=1e-9, equal_nan=True)
+        masks.append(DictFunc.apply_function_to_timeseries(expected, DictFunc.binarize, lower_bound=METRICS[name]))
+        if name in NAN_CLASSIFIERS:
+            assert results[name]['gaps'] == DictFunc.apply_function_to_timeseries([gap], classify, 1024, signal_type)
+    assert {key: mask[key] for key in dataset} == DictFunc.combine_nested_masks(masks)
+
+
+def test_evaluate_quality_scores_nan_channels():
+    signal = np.random.default_rng(0).standard_normal(4096)
+    signal[:100] = np.nan
+    results, mask = DictFunc.evaluate_quality({'a': [signal]}, {'Completeness': None, 'Amplitude': 1}, fs=1024)
+    assert results['Completeness'] == {'a': [pytest.approx(100 * 100 / 4096)]}
+    assert results['Amplitude'] == {'a': [1]} and mask == {'a': [1]}
+
+
+def _shared_blocks():
+    return {name for name in os.listdir('/dev/shm') if name.startswith('psm_')}
+
+
+def test_parallel_matches_serial():
+    dataset = _dataset()
+    metrics = {'Completeness': 95, 'Amplitude': 3, 'SNR': 2, 'Powerline': 3}
+    before = _shared_blocks()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        parallel = DictFunc.evaluate_quality(dataset, metrics, fs=1024, executor=executor)
+    assert parallel == DictFunc.evaluate_quality(dataset, metrics, fs=1024)
+    assert _shared_blocks() <= before
+
+
+def test_parallel_frees_shared_memory_when_a_channel_fails(tmp_path):
+    # A lazy channel whose data file is missing fails while the shared memory block is being filled
+    missing = ChannelHandle(str(tmp_path / 'missing.eeg'), '<f4', 'MULTIPLEXED', 1, 4096, 0, 1e-6, 'C001')
+    dataset = {'healthy': [np.zeros(4096), missing]}
+    before = _shared_blocks()
+    with ThreadPoolExecutor(max_workers=2) as executor, pytest.raises(FileNotFoundError):
+        DictFunc.evaluate_quality(dataset, {'Completeness': 95}, fs=1024, executor=executor)
+    assert _shared_blocks() <= before
+
+
+def test_parallel_frees_shared_memory_when_a_copy_fails():
+    dataset = {'healthy': [np.zeros(4096), np.array(['not a sample'] * 4096)]}
+    before = _shared_blocks()
+    with ThreadPoolExecutor(max_workers=2) as executor, pytest.raises(ValueError):
+        DictFunc.evaluate_quality(dataset, {'Completeness': 95}, fs=1024, executor=executor)
+    assert _shared_blocks() <= before
+
+
+def test_pca_levels_grade_missing_values_as_poor():
+    assert DictFunc.pca_levels(None) == 1
+    np.testing.assert_array_equal(DictFunc.pca_levels([0.95, None, np.nan, 0.7]), [3, 1, 1, 1])
+    # pca_and_auc returns None for data that is not an array
+    assert DictFunc.pca_classify(list(np.random.default_rng(0).standard_normal(4096)), 1024, 'EEG') == 1
+
+
+def test_parallel_slices_follow_the_executor_workers():
+    class CountingExecutor(ThreadPoolExecutor):
+        tasks = 0
+
+        def submit(self, *args, **kwargs):
+            CountingExecutor.tasks += 1
+            return super().submit(*args, **kwargs)
+
+    rng = np.random.default_rng(0)
+    dataset = {'healthy': [rng.standard_normal(1024) for _ in range(64)]}
+    with CountingExecutor(max_workers=8) as executor:
+        # n_jobs is left at the evaluate_quality default of 1
+        DictFunc.evaluate_quality(dataset, {'Completeness': 95}, fs=1024, executor=executor)
+    # A few slices per worker of the pool, not per n_jobs
+    assert CountingExecutor.tasks >= 4 * 8
+
+
+def test_traversal_counter_counts_every_walk():
+    from Benchmarks import TraversalCounter
+    dataset = {'a': [np.ones((1, 256)), np.ones((1, 256))]}
+    metrics = {'Completeness': 95, 'Uniqueness': 95}
+    with TraversalCounter() as counter:
+        DictFunc.evaluate_quality(dataset, metrics, fs=256)
+    # from_nested, its skeleton map, then to_nested once per metric and once for the mask
+    assert counter.traversals == 2 + len(metrics) + 1
+    with TraversalCounter() as counter:
+        DictFunc.apply_function_to_timeseries(dataset, len)
+    assert counter.traversals == 1
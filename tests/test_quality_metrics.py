@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import QualityMetrics
+
+
+def test_power_line_noise_matches_the_full_fft():
+    rng = np.random.default_rng(0)
+    t = np.arange(2048 * 4) / 2048
+    data = rng.standard_normal((3, len(t))) + np.sin(2 * np.pi * 50 * t)
+    spectrum = np.abs(np.fft.fft(data, axis=-1))
+    reference = spectrum[:, np.argmin(np.abs(np.fft.fftfreq(len(t), 1 / 2048) - 50))]
+    np.testing.assert_allclose(QualityMetrics.power_line_noise(data, 2048), reference)
+    assert np.isclose(QualityMetrics.power_line_noise(data[0], 2048), reference[0])
+
+
+def test_power_line_noise_below_100_hz_is_nan():
+    data = np.random.default_rng(0).standard_normal((2, 512))
+    assert np.isnan(QualityMetrics.power_line_noise(data[0], 64))
+    assert np.isnan(QualityMetrics.power_line_noise(data, 64)).all()
+    amplitudes, frequencies = QualityMetrics.power_line_harmonics(data, 64)
+    assert amplitudes.shape == (2, 0) and len(frequencies) == 0
+
+
+@pytest.mark.filterwarnings('error')
+@pytest.mark.parametrize('n_samples', [100, 200, 520])
+def test_hurst_is_nan_without_two_window_sizes(n_samples):
+    signals = np.random.default_rng(0).standard_normal((3, n_samples))
+    assert np.isnan(QualityMetrics.hurst_batch(signals)).all()
+
+
+@pytest.mark.parametrize('shape', [(50, 3), (50, 3, 4), (50, 2, 3, 2)])
+def test_uniqueness_matches_the_per_dimension_loop(shape):
+    signal = np.random.default_rng(0).integers(0, 3, size=shape)
+    # Loop of the original uniqueness over the dimensions of axis 1
+    expected = np.mean([np.sum(signal[:-1, dim] != signal[1:, dim]) / (shape[0] - 1) * 100
+                        for dim in range(shape[1])])
+    assert np.isclose(QualityMetrics.uniqueness(signal), expected)
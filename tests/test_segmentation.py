@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from SignalDictBuilder import segment_signal
+
+
+def test_drop_discards_the_trailing_samples():
+    segments = segment_signal(np.arange(10.0), segment_len=4)
+    np.testing.assert_array_equal(segments, [[0, 1, 2, 3], [4, 5, 6, 7]])
+    # The segments are a view of the signal
+    assert not segments.flags.owndata
+
+
+def test_pad_fills_the_last_segment_with_nan():
+    segments = segment_signal(np.arange(10.0), segment_len=4, edge='pad')
+    assert segments.shape == (3, 4)
+    np.testing.assert_array_equal(segments[-1, :2], [8, 9])
+    assert np.isnan(segments[-1, 2:]).all()
+
+
+def test_pad_with_overlap_covers_every_sample():
+    samples = np.arange(11.0)
+    segments = segment_signal(samples, segment_len=4, overlap=2, edge='pad')
+    np.testing.assert_array_equal(segments[:, 0], [0, 2, 4, 6, 8])
+    assert segments[-1, 2] == 10 and np.isnan(segments[-1, 3])
+
+
+@pytest.mark.parametrize('edge', ['drop', 'pad'])
+def test_exact_fit_has_no_padding(edge):
+    segments = segment_signal(np.arange(8.0), segment_len=4, edge=edge)
+    np.testing.assert_array_equal(segments, [[0, 1, 2, 3], [4, 5, 6, 7]])
+
+
+def test_short_signals():
+    assert segment_signal(np.arange(3.0), segment_len=4).shape == (0, 4)
+    padded = segment_signal(np.arange(3.0), segment_len=4, edge='pad')
+    assert padded.shape == (1, 4) and np.isnan(padded[0, 3])
+    for edge in ('drop', 'pad'):
+        assert segment_signal(np.array([]), segment_len=4, edge=edge).shape == (0, 4)
+
+
+def test_nan_policy():
+    samples = np.arange(12.0)
+    samples[5] = np.nan
+    np.testing.assert_array_equal(segment_signal(samples, segment_len=4, nan_policy='drop')[:, 0], [0, 8])
+    with pytest.raises(ValueError):
+        segment_signal(samples, segment_len=4, nan_policy='raise')
+    # The NaN padding counts as missing samples
+    assert len(segment_signal(np.arange(10.0), segment_len=4, edge='pad', nan_policy='drop')) == 2
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        segment_signal(np.arange(10.0), segment_len=4, overlap=4)
+    with pytest.raises(ValueError):
+        segment_signal(np.arange(10.0), segment_len=4, edge='wrap')
+    with pytest.raises(ValueError):
+        segment_signal(np.zeros((2, 10)), segment_len=4)
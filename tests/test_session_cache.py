@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import SignalDictBuilder
+from Benchmarks import write_synthetic_session
+
+
+def _load(root, cache_path, capsys):
+    sessions = {f'{patient_id}_{situation_id}': session['healthy']
+                for patient_id, situation_id, session, _ in SignalDictBuilder.load_sessions(root, cache_path=cache_path)}
+    sources = [line.rsplit('(', 1)[1].rstrip(')') for line in capsys.readouterr().out.splitlines()
+               if ' loaded in ' in line]
+    return sessions, sources
+
+
+def test_cache_is_invalidated_when_files_change(tmp_path, capsys):
+    root = str(tmp_path / 'data')
+    cache_path = str(tmp_path / 'cache.h5')
+    for subject in ('01', '02'):
+        write_synthetic_session(root, subject, '01', n_channels=12, n_samples=2048, sfreq=256)
+
+    first, sources = _load(root, cache_path, capsys)
+    assert sources == ['decoded', 'decoded']
+    size = os.path.getsize(cache_path)
+    cached, sources = _load(root, cache_path, capsys)
+    assert sources == ['cached', 'cached']
+    np.testing.assert_array_equal(np.vstack(cached['sub-01_ses-01'][1]), np.vstack(first['sub-01_ses-01'][1]))
+
+    # Rewriting one session with other samples changes its signature
+    vhdr_file = write_synthetic_session(root, '02', '01', n_channels=12, n_samples=2048, sfreq=256, seed=1)
+    data_file = os.path.splitext(vhdr_file)[0] + '.eeg'
+    os.utime(data_file, ns=(os.stat(data_file).st_atime_ns, os.stat(data_file).st_mtime_ns + 10 ** 9))
+    updated, sources = _load(root, cache_path, capsys)
+    assert sources == ['cached', 'decoded']
+    assert not np.array_equal(np.vstack(updated['sub-02_ses-01'][1]), np.vstack(first['sub-02_ses-01'][1]))
+
+    # The outdated session does not stay in the file
+    assert os.path.getsize(cache_path) < 1.1 * size
+    assert not os.path.exists(cache_path + '.tmp')
+
+
+def test_signature_follows_the_header_data_file(tmp_path):
+    vhdr_file = write_synthetic_session(str(tmp_path), '01', '01', n_channels=4, n_samples=256, sfreq=256)
+    data_file = os.path.splitext(vhdr_file)[0] + '.eeg'
+    renamed = os.path.join(os.path.dirname(vhdr_file), 'renamed.eeg')
+    os.rename(data_file, renamed)
+    with open(vhdr_file, encoding='utf-8') as f:
+        header = f.read().replace(f'DataFile={os.path.basename(data_file)}', 'DataFile=renamed.eeg')
+    with open(vhdr_file, 'w', encoding='utf-8') as f:
+        f.write(header)
+
+    signature = SignalDictBuilder.session_signature(vhdr_file)
+    assert 'renamed.eeg' in signature
+
+
+def test_sessions_without_signature_are_decoded_again(tmp_path, capsys):
+    import h5py
+    root = str(tmp_path / 'data')
+    cache_path = str(tmp_path / 'cache.h5')
+    for subject in ('01', '02'):
+        write_synthetic_session(root, subject, '01', n_channels=12, n_samples=2048, sfreq=256)
+    first, _ = _load(root, cache_path, capsys)
+
+    # A run interrupted before the signature of a session was written
+    with h5py.File(cache_path, 'a') as cache:
+        del cache['sub-01_ses-01'].attrs['signature']
+    reloaded, sources = _load(root, cache_path, capsys)
+    assert sources == ['decoded', 'cached']
+    np.testing.assert_array_equal(np.vstack(reloaded['sub-01_ses-01'][1]), np.vstack(first['sub-01_ses-01'][1]))
+    with h5py.File(cache_path, 'r') as cache:
+        assert 'signature' in cache['sub-01_ses-01'].attrs
@@ -0,0 +1,54 @@
+from concurrent.futures import Future
+import numpy as np
+import pytest
+import mne
+import SignalDictBuilder
+from Benchmarks import write_brainvision, write_synthetic_session
+
+
+def test_read_vhdr_header_decodes_comma_escape(tmp_path):
+    vhdr_file = str(tmp_path / 'rec.vhdr')
+    data = np.random.default_rng(0).standard_normal((2, 100)) * 1e-5
+    write_brainvision(vhdr_file, data, 100, ['A,B', 'C'])
+
+    header = SignalDictBuilder.read_vhdr_header(vhdr_file)
+    assert header['ch_names'] == ['A,B', 'C']
+    assert header['ch_names'] == mne.io.read_raw_brainvision(vhdr_file, verbose=False).ch_names
+
+
+def test_load_sessions_yields_row_views(tmp_path):
+    write_synthetic_session(str(tmp_path), '01', '01', n_channels=12, n_samples=512, sfreq=256)
+
+    (_, _, session, _), = SignalDictBuilder.load_sessions(str(tmp_path))
+    ch_names, channels = session['healthy']
+    assert len(channels) == len(ch_names)
+    assert all(channel.shape == (1, 512) for channel in channels)
+    # Every channel is a view of the one session array
+    assert all(np.shares_memory(channel, channels[0].base) for channel in channels)
+
+
+def test_bounded_map_keeps_order_and_window():
+    submitted = []
+    consumed = []
+
+    class Executor:
+        def submit(self, func, item):
+            submitted.append(item)
+            future = Future()
+            future.set_result(func(item))
+            return future
+
+    for result in SignalDictBuilder._bounded_map(Executor(), lambda x: x * 2, range(10), 3):
+        consumed.append(result)
+        # The next item is submitted before the current result is handed out
+        assert len(submitted) - len(consumed) <= 3
+    assert consumed == [x * 2 for x in range(10)]
+
+
+@pytest.mark.parametrize('n_jobs', [0, -2, 1.5])
+def test_invalid_n_jobs_is_rejected(tmp_path, n_jobs):
+    write_synthetic_session(str(tmp_path), '01', '01', n_channels=12, n_samples=512, sfreq=256)
+    with pytest.raises(ValueError, match='n_jobs'):
+        SignalDictBuilder.structure_data(str(tmp_path), 'classifier', n_jobs=n_jobs)
+    with pytest.raises(ValueError, match='n_jobs'):
+        next(SignalDictBuilder.load_sessions(str(tmp_path), n_jobs=n_jobs))
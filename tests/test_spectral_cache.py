@@ -0,0 +1,40 @@
+import numpy as np
+from scipy.signal import welch
+from SpectralCache import SpectralCache
+
+
+def test_welch_matches_scipy_and_returns_writable_copies():
+    cache = SpectralCache()
+    signal = np.random.default_rng(0).standard_normal(1024)
+    f, psd = cache.welch(signal, 256, nperseg=256)
+    np.testing.assert_array_equal(psd, welch(signal, 256, nperseg=256)[1])
+    psd[:] = 0
+    _, cached = cache.welch(signal, 256, nperseg=256)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cached.any()
+
+
+def test_entries_are_bounded_by_bytes():
+    signals = np.random.default_rng(0).standard_normal((4, 1024))
+    nbytes = sum(array.nbytes for array in welch(signals[0], 256, nperseg=256))
+    cache = SpectralCache(max_bytes=2 * nbytes)
+    for signal in signals:
+        cache.welch(signal, 256, nperseg=256)
+    assert cache.nbytes == 2 * nbytes
+    # Only the two most recent PSDs are kept
+    cache.welch(signals[0], 256, nperseg=256)
+    cache.welch(signals[3], 256, nperseg=256)
+    assert (cache.hits, cache.misses) == (1, 5)
+
+
+def test_caller_key_skips_hashing(monkeypatch):
+    cache = SpectralCache()
+    monkeypatch.setattr(SpectralCache, 'signal_key', staticmethod(lambda signal: 1 / 0))
+    signal = np.random.default_rng(0).standard_normal(1024)
+    cache.welch(signal, 256, nperseg=256, key=('sub-01', 'C001'))
+    cache.welch(signal, 256, nperseg=256, key=('sub-01', 'C001'))
+    assert cache.hits == 1
+
+    disabled = SpectralCache(max_bytes=0)
+    disabled.welch(signal, 256, nperseg=256)
+    assert disabled.nbytes == 0 and disabled.misses == 0